@@ -7,9 +7,27 @@ import torch
 import torch.nn.functional as F
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
+import numpy as np
 import os
 
 
+class ImagePathDataset(torch.utils.data.Dataset):
+    # decodes the images inside the DataLoader workers, so JPEG decoding runs in parallel
+
+    def __init__(self, image_paths, transform):
+        self.image_paths = list(image_paths)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        with open(self.image_paths[idx], "rb") as f:
+            img = Image.open(f)
+            img = img.convert('RGB')
+        return self.transform(img)
+
+
 class Args:
     
     def __init__(self):
@@ -20,11 +38,15 @@ class Args:
         
 class BDD100k_classifier:
     
-    def __init__(self, device = "cpu"):
+    def __init__(self, device = "cpu", cache = None):
         self.device = device
+        # optional prediction_cache.PredictionCache shared with the other classifiers
+        self.cache = cache
         self.args = Args()
         self.classifier = get_classifier(self.args)
-        self.classifier.to(device).eval()
+        # channels-last lets the CPU convolution kernels run without layout conversions, the inputs of
+        # every path (classify, margin, classify_batch) are converted to it as well
+        self.classifier.to(device, memory_format=torch.channels_last).eval()
         
         image_size = 256
         normalize=False
@@ -40,12 +62,128 @@ class BDD100k_classifier:
         
         
     def classify(self, image_path):
+        if self.cache is not None:
+            return self.cache.cached(self._classify, image_path, f"BDD100k:{self.args.classifier_path}")
+        return self._classify(image_path)
+
+    @torch.inference_mode()
+    def _classify(self, image_path):
         with open(image_path, "rb") as f:
             img = Image.open(f)
             img = img.convert('RGB')
 
-        img = self.transform(img)
-        
-        img = img.to(self.device)
+        img = self.load(img)
         pred = (self.classifier(img) > 0).int()
-        return int (pred[0])
+        return int (pred.reshape(-1)[0])
+
+    def load(self, img):
+        # PIL image -> (1, C, H, W) channels-last input of the classifier
+        return self.transform(img).unsqueeze(0).to(self.device).contiguous(memory_format=torch.channels_last)
+
+    @torch.inference_mode()
+    def margin(self, image_path, reference = None):
+        """
+        Classification and signed distance to the decision boundary.
+
+        Args:
+            image_path (str): Path of the image.
+            reference (int, optional): Label the margin is measured for, defaults to the predicted one.
+
+        Returns:
+            tuple: (label, margin), label as classify and margin the logit of the queried label,
+                positive while the image is classified as reference.
+        """
+        with open(image_path, "rb") as f:
+            img = Image.open(f)
+            img = img.convert('RGB')
+
+        img = self.load(img)
+        return self.margin_from_logits(self.classifier(img), reference)
+
+    def margin_from_logits(self, logits, reference = None):
+        # margin on the output of the classifier for one image
+        logit = float(logits.reshape(-1)[0])
+        label = int(logit > 0)
+        reference = label if reference is None else reference
+        return label, logit if reference == 1 else -logit
+
+    def incremental(self, max_fraction = 0.35, until = None, full_every = 4, check_image = None, postprocess = None):
+        """
+        Incremental scorer for the steps of an edit chain, see incremental_classifier.IncrementalClassifier.
+        score(step_path) returns the label of classify; score(step_path, mask) approximates it, taking
+        the pixels outside the mask as those of the previous step, and every full_every-th step is
+        recomputed in full.
+
+        Args:
+            check_image (str, optional): Image on which the split of the classifier is checked against
+                the full forward pass (ValueError if they differ).
+            postprocess (callable, optional): Replaces the label, e.g. to get the logits.
+        """
+        from incremental_classifier import IncrementalClassifier, split_model, verify_split
+        stem, head = split_model(self.classifier, until)
+        if check_image is not None:
+            with open(check_image, "rb") as f:
+                img = Image.open(f).convert('RGB')
+            verify_split(self.classifier, stem, head, self.load(img))
+        mask_transform = transforms.Compose([transforms.Resize((256, 512)), transforms.ToTensor()])
+        if postprocess is None:
+            postprocess = lambda logits: int(logits.reshape(logits.shape[0], -1)[0, 0] > 0)
+        return IncrementalClassifier(stem, head, self.transform, mask_transform, postprocess=postprocess,
+                                     device=self.device, max_fraction=max_fraction, full_every=full_every)
+
+    def incremental_margin(self, **kwargs):
+        """
+        Same as margin for MarginScheduler, but the steps classified with their inpainting mask are
+        re-scored incrementally. kwargs go to incremental.
+        """
+        from incremental_classifier import IncrementalMargin
+        return IncrementalMargin(self.incremental(postprocess=lambda logits: logits, **kwargs), self.margin_from_logits)
+
+    def iter_batches(self, image_paths, batch_size = 64, num_workers = 4, bf16 = False):
+        """
+        Classifies the images in batches and yields the results batch by batch.
+
+        Args:
+            image_paths (list): Paths of the images to classify.
+            batch_size (int): Number of images per forward pass.
+            num_workers (int): DataLoader workers used for decoding the images.
+            bf16 (bool): Run the forward pass under bfloat16 autocast (CPU only).
+
+        Yields:
+            tuple: (labels, logits) NumPy arrays of the batch, labels has shape (B,) and logits (B, C).
+        """
+        dataset = ImagePathDataset(image_paths, self.transform)
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            pin_memory=str(self.device) != "cpu",
+            persistent_workers=False
+        )
+
+        use_bf16 = bf16 and str(self.device) == "cpu"
+
+        with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_bf16):
+            for imgs in loader:
+                imgs = imgs.to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+                logits = self.classifier(imgs).float().reshape(imgs.shape[0], -1)
+                # same decision rule as classify: the first output is the logit of the queried label
+                labels = (logits[:, 0] > 0).int()
+                yield labels.cpu().numpy(), logits.cpu().numpy()
+
+    def classify_batch(self, image_paths, batch_size = 64, num_workers = 4, bf16 = False):
+        """
+        Batched version of classify.
+
+        Returns:
+            tuple: (labels, logits) NumPy arrays for all the images, in the order of image_paths.
+        """
+        labels, logits = [], []
+        for batch_labels, batch_logits in self.iter_batches(image_paths, batch_size, num_workers, bf16):
+            labels.append(batch_labels)
+            logits.append(batch_logits)
+
+        if not labels:
+            return np.zeros(0, dtype=np.int32), np.zeros((0, 1), dtype=np.float32)
+        return np.concatenate(labels), np.concatenate(logits)
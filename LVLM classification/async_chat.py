@@ -0,0 +1,170 @@
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from multi_chat import Chat
+
+
+# errors for which the request is retried after backing off, only throttling lowers the concurrency
+RETRYABLE_ERRORS = ("ThrottlingException", "ServiceUnavailableException", "ModelNotReadyException", "InternalServerException")
+THROTTLING_ERRORS = ("ThrottlingException",)
+
+
+def bedrock_client(max_concurrency = 64, **kwargs):
+    # the default boto3 pool keeps only 10 connections, which caps the concurrency,
+    # and its own retries are disabled so that throttling reaches the AdaptiveLimiter
+    config = Config(max_pool_connections=max_concurrency, retries={"max_attempts": 1, "mode": "standard"})
+    return boto3.client('bedrock-runtime', config=config, **kwargs)
+
+
+class AdaptiveLimiter:
+    """
+    Bounds the number of in-flight Bedrock requests.
+
+    The limit starts at max_concurrency, is halved whenever a request is throttled and grows
+    back by one after every `limit` successful requests (additive increase, multiplicative decrease).
+    Requests failing for any other reason leave the limit unchanged.
+
+    Args:
+        max_concurrency (int): Upper bound of concurrent requests.
+        min_concurrency (int): The limit never drops below this value.
+    """
+
+    def __init__(self, max_concurrency = 32, min_concurrency = 1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self.condition = None
+        self.loop = None
+        # boto3 is blocking, so the requests themselves run in these threads
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def _condition(self):
+        # created lazily so that the limiter is bound to the loop that actually runs the requests,
+        # every run_sync call starts a new loop
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.condition = asyncio.Condition()
+            self.loop = loop
+        return self.condition
+
+    async def acquire(self):
+        condition = self._condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, outcome = "success"):
+        # outcome is "success", "throttled" or "failed"
+        condition = self._condition()
+        async with condition:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self.throttles += 1
+                self.successes = 0
+                self.limit = max(self.min_concurrency, self.limit // 2)
+            elif outcome == "success":
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.successes = 0
+                    self.limit += 1
+            condition.notify_all()
+
+
+class AsyncChat(Chat):
+    """
+    Chat whose turns can be awaited, so that many independent conversations run concurrently.
+
+    Args:
+        model_id (str): Bedrock model id.
+        bedrock_runtime_client: boto3 bedrock-runtime client (see bedrock_client).
+        limiter (AdaptiveLimiter): Limiter shared by all the conversations of a run.
+        max_retries (int): Attempts per turn before the error is raised.
+        base_delay (float): Base of the exponential backoff in seconds.
+        max_delay (float): Maximum backoff in seconds.
+        **kwargs: History policy arguments of Chat (keep_last_images, image_placeholder).
+    """
+
+    def __init__(self, model_id, bedrock_runtime_client, limiter, max_retries = 8, base_delay = 1.0, max_delay = 30.0, **kwargs):
+        super().__init__(model_id, bedrock_runtime_client, **kwargs)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _invoke(self, body):
+        # the response stream is read here too, in the executor thread, since reading it blocks
+        # until the whole answer has arrived
+        response = self.bedrock_runtime_client.invoke_model(
+            modelId=self.model_id,
+            contentType="application/json",
+            body=body
+        )
+        return response["body"].read()
+
+    async def generate_async(self):
+        loop = asyncio.get_running_loop()
+        body = self.request_body()
+
+        for attempt in range(self.max_retries):
+            await self.limiter.acquire()
+            outcome = "failed"
+            try:
+                output_binary = await loop.run_in_executor(self.limiter.executor, self._invoke, body)
+                outcome = "success"
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code in THROTTLING_ERRORS:
+                    outcome = "throttled"
+                if code not in RETRYABLE_ERRORS or attempt == self.max_retries - 1:
+                    raise
+            finally:
+                await self.limiter.release(outcome)
+
+            if outcome == "success":
+                return self.add_response_bytes(output_binary)
+
+            # full jitter keeps the throttled conversations from retrying in lockstep
+            await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+
+async def gather_conversations(conversations, return_exceptions = True):
+    """
+    Runs coroutines (e.g. one per image, each driving its own AsyncChat) concurrently.
+
+    Returns:
+        list: Results in the order of conversations, exceptions are returned in place when return_exceptions is set.
+    """
+    return await asyncio.gather(*conversations, return_exceptions=return_exceptions)
+
+
+def run_sync(coroutine):
+    # asyncio.run refuses to start inside an already running loop (e.g. a Jupyter kernel),
+    # in that case the coroutine is run on its own loop in a helper thread
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result = {}
+
+    def target():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
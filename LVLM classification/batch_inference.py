@@ -0,0 +1,166 @@
+import json
+import os
+import time
+
+from multi_chat import Chat, load_image
+
+
+# Offline classification through Bedrock Batch Inference: the Chat payloads of a whole image set
+# are serialized to a JSONL file, submitted as one job and the answers are merged back into the
+# same source_classes structure that predict_classes_claude fills.
+
+
+def build_records(image_names, classification_prompt, model_id, n_votes = 1, encoder = None):
+    """
+    Builds one batch record per image and vote.
+
+    Returns:
+        tuple: (records, record_map), records are {"recordId", "modelInput"} dicts and
+            record_map maps each recordId back to its image name.
+    """
+    records, record_map = [], {}
+    for i, name in enumerate(image_names):
+        chat = Chat(model_id, None)
+        chat.add_user_message_image(classification_prompt, load_image(name, encoder))
+        for vote in range(n_votes):
+            record_id = f"{i:08d}-{vote:02d}"
+            records.append({"recordId": record_id, "modelInput": chat.payload})
+            record_map[record_id] = name
+    return records, record_map
+
+
+def write_jsonl(records, path):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def merge_results(output_path, record_map, source_classes):
+    """
+    Appends the answers of a batch output file to source_classes[image_name], lowercased
+    like predict_classes_claude does. Failed records are reported and skipped.
+    """
+    for record in read_jsonl(output_path):
+        name = record_map.get(record["recordId"])
+        if name is None:
+            continue
+        if "modelOutput" not in record:
+            print("ValidationException occured in ", name, record.get("error"))
+            continue
+        source_classes[name].append(record["modelOutput"]["content"][0]["text"].lower())
+    return source_classes
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for Bedrock Batch Inference, used for testing the offline mode.
+
+    Args:
+        respond_fn (callable): respond_fn(model_input) -> answer text, e.g. a fixture lookup or a live Chat call.
+    """
+
+    def __init__(self, respond_fn):
+        self.respond_fn = respond_fn
+
+    def run(self, input_path, output_dir):
+        # mirrors the Bedrock output layout: <output_dir>/<input file name>.out
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, os.path.basename(input_path) + ".out")
+        with open(output_path, "w") as f:
+            for record in read_jsonl(input_path):
+                try:
+                    text = self.respond_fn(record["modelInput"])
+                    record["modelOutput"] = {"content": [{"type": "text", "text": text}]}
+                except Exception as e:
+                    record["error"] = {"errorMessage": str(e)}
+                f.write(json.dumps(record) + "\n")
+        return output_path
+
+
+class BedrockBatchBackend:
+    """
+    Submits the JSONL to a Bedrock model invocation job through S3 and waits for it.
+
+    Note that Bedrock requires a minimum number of records per job (100 at the time of writing).
+
+    Args:
+        bedrock_client: boto3 'bedrock' client (control plane, not 'bedrock-runtime').
+        s3_client: boto3 's3' client.
+        bucket (str): S3 bucket for the job input and output.
+        prefix (str): Key prefix under which the job files are stored.
+        role_arn (str): IAM role that Bedrock assumes to read and write the bucket.
+        model_id (str): Model used by the job.
+        poll_interval (int): Seconds between job status checks.
+    """
+
+    FINISHED = ("Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired")
+
+    def __init__(self, bedrock_client, s3_client, bucket, prefix, role_arn, model_id, poll_interval = 60):
+        self.bedrock_client = bedrock_client
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.role_arn = role_arn
+        self.model_id = model_id
+        self.poll_interval = poll_interval
+
+    def run(self, input_path, output_dir):
+        job_name = f"v-cece-{int(time.time())}"
+        input_key = f"{self.prefix}/{job_name}/input/{os.path.basename(input_path)}"
+        output_prefix = f"{self.prefix}/{job_name}/output/"
+        self.s3_client.upload_file(input_path, self.bucket, input_key)
+
+        job = self.bedrock_client.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{self.bucket}/{input_key}"}},
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{self.bucket}/{output_prefix}"}}
+        )
+
+        while True:
+            status = self.bedrock_client.get_model_invocation_job(jobIdentifier=job["jobArn"])["status"]
+            if status in self.FINISHED:
+                break
+            time.sleep(self.poll_interval)
+        if status not in ("Completed", "PartiallyCompleted"):
+            raise RuntimeError(f"Batch job {job_name} finished with status {status}")
+
+        # the results are written under <output prefix>/<job id>/<input file name>.out
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, os.path.basename(input_path) + ".out")
+        suffix = os.path.basename(input_path) + ".out"
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=output_prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(suffix):
+                    self.s3_client.download_file(self.bucket, obj["Key"], output_path)
+                    return output_path
+        raise FileNotFoundError(f"No output found for batch job {job_name} under s3://{self.bucket}/{output_prefix}")
+
+
+def predict_classes_batch(image_names, source_classes, classification_prompt, backend, model_id, n_votes = 1, work_dir = "batch_jobs", encoder = None):
+    """
+    Offline counterpart of predict_classes_claude: all the images and votes are sent as a single batch job.
+
+    Only single-turn prompting is supported, the analyze-then-predict mode needs the answer of
+    the first turn before the second one can be sent.
+
+    Returns:
+        defaultdict: source_classes with the answers of every vote appended per image.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    records, record_map = build_records(image_names, classification_prompt, model_id, n_votes, encoder)
+    input_path = os.path.join(work_dir, f"records-{int(time.time())}.jsonl")
+    write_jsonl(records, input_path)
+
+    output_path = backend.run(input_path, work_dir)
+    return merge_results(output_path, record_map, source_classes)
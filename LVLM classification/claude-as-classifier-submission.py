@@ -8,6 +8,8 @@ import re
 import pickle
 from claude_predictor import *
 from multi_chat import Chat
+from async_chat import AdaptiveLimiter, bedrock_client
+from voting import MajorityVoter, claude_vote_fn
 import boto3
 from collections import defaultdict, Counter
 
@@ -56,23 +58,16 @@ Return me only the label of the scene depicted and nothing else.
 """
 
 # ## Predict
-source_classes = defaultdict(list)
+# The 7 votes of each image are issued concurrently and stop early once a label has an unassailable majority.
+# Answers outside the PLACES classes do not count, unless no answer of the image is a valid class.
+voting_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+limiter = AdaptiveLimiter(max_concurrency=32)
+voting_client = bedrock_client(max_concurrency=32)
 
-for ii in range(7):
-    source_classes = predict_classes_claude(image_names_claude, source_classes, classification_prompt, prompt_analyze, text_prompt, analyze=False)
-    
-# clean responses, especially '\n' character, if present
-source_classes_clean = defaultdict(list, {k: list(map(lambda x: x.replace('\n', ''), v)) for k, v in source_classes.items()})
-
-# filter out items that do not belong to PLACES classes
-source_classes_filtered = {key: list(filter(lambda item: item in processed_categories, items)) for key, items in source_classes_clean.items()}
-
-for key in source_classes_filtered:
-    if not source_classes_filtered[key]:  # Checks if the list is empty
-        source_classes_filtered[key] = source_classes_clean[key]
-
-# substitute each value list with the most frequent element from the lists per key
-source_classes = defaultdict(list, {k: (lambda v: Counter(v).most_common(1)[0][0])(v) for k, v in source_classes_filtered.items()})
+voter = MajorityVoter(claude_vote_fn(voting_model_id, voting_client, limiter, classification_prompt, prompt_analyze, text_prompt, analyze=False),
+                      n_votes=7, valid_labels=processed_categories)
+votes = voter.vote_many(image_names_claude)
+source_classes = defaultdict(list, {k: v.label for k, v in votes.items() if v.label is not None})
 
 for class_ in source_classes:
     print(source_classes[class_])
@@ -85,25 +80,10 @@ with open('claude-sonnet-as-classifier_source_class_claude.pickle', 'wb') as f:
 # ## Analyze-then-predict
 # 
 # This prompt seems more stable in comparison to the non-analyze one
-source_classes_analyze = defaultdict(list)
-
-for ii in range(7):
-    source_classes_analyze = predict_classes_claude(image_names_claude, source_classes_analyze, classification_prompt, 
-                                                 prompt_analyze, text_prompt, analyze=True)
-
-source_classes_analyze_clean = defaultdict(list, {k: list(map(lambda x: x.replace('\n', ''), v)) for k, v in source_classes_analyze.items()})
-
-# filter out items that do not belong to PLACES classes
-source_classes_analyze_filtered = {key: list(filter(lambda item: item in processed_categories, items)) for key, items in source_classes_analyze_clean.items()}
-
-
-for key in source_classes_analyze_filtered:
-    if not source_classes_analyze_filtered[key]:  # Checks if the list is empty
-        source_classes_analyze_filtered[key] = source_classes_analyze_clean[key]
-
-
-# substitute each value list with the most frequent element from the lists per key
-source_classes_analyze = defaultdict(list, {k: (lambda v: Counter(v).most_common(1)[0][0])(v) for k, v in source_classes_analyze_filtered.items()})
+voter_analyze = MajorityVoter(claude_vote_fn(voting_model_id, voting_client, limiter, classification_prompt, prompt_analyze, text_prompt, analyze=True),
+                              n_votes=7, valid_labels=processed_categories)
+votes_analyze = voter_analyze.vote_many(image_names_claude)
+source_classes_analyze = defaultdict(list, {k: v.label for k, v in votes_analyze.items() if v.label is not None})
 
 for s in source_classes_analyze:
     print(source_classes_analyze[s])
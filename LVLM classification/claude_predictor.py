@@ -3,6 +3,10 @@ from collections import defaultdict
 from multi_chat import *
 import boto3
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from result_index import ResultIndex
 
 bedrock_runtime_client = boto3.client(
     'bedrock-runtime'
@@ -105,46 +109,50 @@ def all_images(image_directory, display=False):
     return image_names, counterfactuals
 
 
-def source_images(image_directory, display=False):
-    images = []
-    image_names = []
-    
-    for filename in os.listdir(image_directory):
-        filename=image_directory+filename+'/'
-        for im in os.listdir(filename):
-            if im.endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):    # is image file
-                if im.startswith(('source')):
-                    image_path = os.path.join(filename, im)
-                    image_names.append(image_path)
-                
-        if display:
-            for img in images:
-                plt.imshow(img)
-                plt.axis('off')  # Hide axis
-                plt.show()  # Display the image
-    return image_names
+def source_images(image_directory, display=False, index_path=None):
+    # source images of every run folder, read from the result index (kept in index_path between
+    # calls if given) instead of listing every folder
+    return ResultIndex.open(image_directory, index_path).source_paths()
+
+def counterfactual_images(image_directory, index_path=None):
+    """
+    Source images and their counterfactuals (the largest step_i.jpg of the run, None if no step was
+    saved), as keep_largest_digit_image would find them.
+    """
+    records = [r for r in ResultIndex.open(image_directory, index_path).records() if r['source_path'] is not None]
+    return [r['source_path'] for r in records], [r['final_step_path'] for r in records]
 
 def generate_prompt(categories):
     # Join the categories into a readable list format
     categories_str = ", ".join(categories)
     return categories_str
 
-def predict_classes_claude(image_names, source_classes, classification_prompt, prompt_analyze, text_prompt, analyze=False):
+def predict_classes_claude(image_names, source_classes, classification_prompt, prompt_analyze, text_prompt, analyze=False, cache=None, encoder=None):
     model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+    prompt = prompt_analyze + text_prompt if analyze else classification_prompt
     for name in tqdm(image_names):    
+        # the n-th vote of an image is cached separately from the others, so repeated votes stay independent
+        if cache is not None:
+            key = cache.key(name, f"{model_id}:analyze={analyze}:vote={len(source_classes[name])}", prompt, encoder)
+            found, answer_source = cache.get(key)
+            if found:
+                source_classes[name].append(answer_source)
+                continue
         chat = Chat(model_id, bedrock_runtime_client) # create a chat like openning a new chat in 
         if analyze:
             try:
-                chat.add_user_message_image(prompt_analyze, load_image(name)) # analyze image
+                chat.add_user_message_image(prompt_analyze, load_image(name, encoder)) # analyze image
                 chat.generate()
                 chat.add_user_message(text_prompt)                            # answer about the analyzed image
             except:
                 print("ValidationException occured in ", name)
         else:
-            chat.add_user_message_image(classification_prompt, load_image(name)) # add a user message with an image and a text prompt
+            chat.add_user_message_image(classification_prompt, load_image(name, encoder)) # add a user message with an image and a text prompt
         try:
             answer_source = chat.generate().lower()
             source_classes[name].append(answer_source)
+            if cache is not None:
+                cache.put(key, answer_source)
         except:
             print("ValidationException occured in ", name)  
     return source_classes
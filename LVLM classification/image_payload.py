@@ -0,0 +1,64 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class ImageEncoder:
+    """
+    Prepares images for the Chat image messages.
+
+    Images are downsized so that their long edge is at most max_edge, re-encoded as JPEG at the
+    given quality and the base64 payloads are memoized by file content hash + settings in a
+    bounded LRU, so the same source.jpg/step_i.jpg is encoded once for all votes and prompts.
+
+    Args:
+        max_edge (int, optional): Maximum length of the long edge in pixels, None keeps the size.
+        quality (int): JPEG quality of the re-encoded image.
+        cache_size (int): Maximum number of payloads kept in memory.
+    """
+
+    def __init__(self, max_edge = 1024, quality = 85, cache_size = 256):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _encode(self, data):
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert("RGB")
+            if self.max_edge is not None and max(img.size) > self.max_edge:
+                scale = self.max_edge / max(img.size)
+                img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG", quality=self.quality)
+        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+    def settings(self):
+        # the payload settings, part of the prediction cache key since they change what the model sees
+        return f"max_edge={self.max_edge}:quality={self.quality}"
+
+    def encode(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        key = (hashlib.sha1(data).hexdigest(), self.max_edge, self.quality)
+
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+
+        encoded = self._encode(data)
+        with self.lock:
+            self.cache[key] = encoded
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return encoded
@@ -10,7 +10,7 @@ bedrock_runtime_client = boto3.client(
 
 class Chat:
 
-    def __init__(self, model_id, bedrock_runtime_client):
+    def __init__(self, model_id, bedrock_runtime_client, keep_last_images=None, image_placeholder="[image of an earlier step omitted]"):
         self.model_id = model_id
         self.bedrock_runtime_client = bedrock_runtime_client
         self.payload = {
@@ -18,6 +18,12 @@ class Chat:
             "max_tokens": 20000,
             "anthropic_version": "bedrock-2023-05-31"
         }
+        # history policy: only the images of the last keep_last_images user turns are resent,
+        # older images are replaced by a text placeholder (None keeps every image)
+        self.keep_last_images = keep_last_images
+        self.image_placeholder = image_placeholder
+        # size in bytes of the body of every request sent by this chat
+        self.request_bytes = []
 
 
 
@@ -122,16 +128,47 @@ class Chat:
                                 })
 
 
+    def compact_history(self):
+        # copy of the payload to send: the images of the user turns before the last keep_last_images
+        # ones are replaced by the placeholder, self.payload keeps the full history
+        if self.keep_last_images is None:
+            return self.payload
+
+        messages = []
+        image_turns = 0
+        for message in reversed(self.payload["messages"]):
+            if any(block["type"] == "image" for block in message["content"]):
+                image_turns += 1
+                if image_turns > self.keep_last_images:
+                    message = dict(message, content=[{"type": "text", "text": self.image_placeholder} if block["type"] == "image" else block
+                                                     for block in message["content"]])
+            messages.append(message)
+        return dict(self.payload, messages=messages[::-1])
+
+    def request_body(self):
+        body = json.dumps(self.compact_history())
+        self.request_bytes.append(len(body))
+        return body
+
+    @property
+    def bytes_sent(self):
+        return sum(self.request_bytes)
+
     def generate(self):
         response = self.bedrock_runtime_client.invoke_model(
             modelId=self.model_id,
             contentType="application/json",
-            body=json.dumps(self.payload)
+            body=self.request_body()
         )
+        return self.add_response(response)
 
+    def add_response(self, response):
         # now we need to read the response. It comes back as a stream of bytes so if we want to display the response in one go we need to read the full stream first
         # then convert it to a string as json and load it as a dictionary so we can access the field containing the content without all the metadata noise
-        output_binary = response["body"].read()
+        return self.add_response_bytes(response["body"].read())
+
+    def add_response_bytes(self, output_binary):
+        # the already read body of an invoke_model response
         output_json = json.loads(output_binary)
         output = output_json["content"][0]["text"]
 
@@ -151,7 +188,10 @@ class Chat:
         return output
 
 
-def load_image(path):
+def load_image(path, encoder=None):
+    # encoder (image_payload.ImageEncoder) downsizes, re-encodes and memoizes the payload
+    if encoder is not None:
+        return encoder.encode(path)
     with open(path, "rb") as f:
         return base64.b64encode(f.read()).decode("utf-8")
   
\ No newline at end of file
@@ -0,0 +1,138 @@
+import asyncio
+import inspect
+from collections import Counter
+
+from multi_chat import load_image
+from async_chat import AsyncChat, gather_conversations, run_sync
+
+
+def clean_vote(answer):
+    # same cleaning as the notebooks: strip, lowercase and drop the '\n' characters
+    return answer.strip().lower().replace('\n', '')
+
+
+class VoteResult:
+
+    def __init__(self, label, votes, valid_votes, failures):
+        self.label = label              # the majority label
+        self.votes = votes              # Counter of all the cleaned answers
+        self.valid_votes = valid_votes  # Counter of the answers that are valid labels
+        self.failures = failures        # number of votes that raised an exception
+
+    @property
+    def n_votes(self):
+        return sum(self.votes.values())
+
+    @property
+    def margin(self):
+        # lead of the majority label over the runner-up, as a fraction of the votes cast
+        counts = self.valid_votes if self.valid_votes else self.votes
+        top = [c for _, c in counts.most_common(2)] + [0, 0]
+        return (top[0] - top[1]) / self.n_votes if self.n_votes else 0.0
+
+    def __repr__(self):
+        return f"VoteResult(label={self.label!r}, votes={dict(self.votes)}, failures={self.failures})"
+
+
+class MajorityVoter:
+    """
+    Majority voting over repeated LVLM classifications of the same image.
+
+    The votes of an image are issued concurrently in waves that are just large enough to
+    possibly decide the vote, and voting stops as soon as the leading label can no longer be
+    overtaken by the votes left (e.g. 4 identical answers out of 7).
+
+    Args:
+        vote_fn (callable): vote_fn(image) -> answer, either a coroutine function or a blocking function.
+        n_votes (int): Maximum number of votes per image.
+        valid_labels (iterable, optional): Answers outside this set are not counted towards the majority
+            (they are only used as a fallback when no answer is valid, as in the notebooks).
+        max_concurrency (int): Maximum concurrent blocking vote_fn calls.
+    """
+
+    def __init__(self, vote_fn, n_votes = 7, valid_labels = None, max_concurrency = 32):
+        self.vote_fn = vote_fn
+        self.n_votes = n_votes
+        self.valid_labels = set(valid_labels) if valid_labels is not None else None
+        self.semaphore = None
+        self.loop = None
+        self.max_concurrency = max_concurrency
+        self.calls = 0
+
+    def is_valid(self, answer):
+        return self.valid_labels is None or answer in self.valid_labels
+
+    def next_wave(self, valid_votes, remaining):
+        # smallest number of extra votes after which the leader could be unassailable
+        counts = [c for _, c in valid_votes.most_common(2)] + [0, 0]
+        leader, second = counts[0], counts[1]
+        if leader > second + remaining:
+            return 0
+        return min(remaining, (second + remaining - leader) // 2 + 1)
+
+    async def _vote(self, image):
+        self.calls += 1
+        if inspect.iscoroutinefunction(self.vote_fn):
+            return await self.vote_fn(image)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, self.vote_fn, image)
+
+    async def vote_async(self, image):
+        # the semaphore belongs to the loop of the current run (run_sync starts a new one per call)
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.loop = loop
+
+        votes, valid_votes = Counter(), Counter()
+        failures, remaining = 0, self.n_votes
+        wave = self.next_wave(valid_votes, remaining)
+        while wave > 0:
+            answers = await asyncio.gather(*[self._vote(image) for _ in range(wave)], return_exceptions=True)
+            remaining -= wave
+            for answer in answers:
+                if isinstance(answer, Exception):
+                    print("ValidationException occured in ", image, answer)
+                    failures += 1
+                    continue
+                answer = clean_vote(answer)
+                votes[answer] += 1
+                if self.is_valid(answer):
+                    valid_votes[answer] += 1
+            wave = self.next_wave(valid_votes, remaining)
+
+        # fall back to the raw answers when none of them is a valid label
+        counts = valid_votes if valid_votes else votes
+        label = counts.most_common(1)[0][0] if counts else None
+        return VoteResult(label, votes, valid_votes, failures)
+
+    async def vote_many_async(self, images):
+        results = await gather_conversations([self.vote_async(image) for image in images], return_exceptions=False)
+        return dict(zip(images, results))
+
+    def vote(self, image):
+        return run_sync(self.vote_async(image))
+
+    def vote_many(self, images):
+        """
+        Returns:
+            dict: image -> VoteResult, all the images are voted concurrently.
+        """
+        return run_sync(self.vote_many_async(images))
+
+
+def claude_vote_fn(model_id, bedrock_runtime_client, limiter, classification_prompt, prompt_analyze = None, text_prompt = None, analyze = False, encoder = None):
+    # builds a vote_fn that asks a fresh conversation for the class of an image,
+    # following the prompting of predict_classes_claude; with an encoder the image
+    # is encoded once and shared by all the votes
+    async def vote_fn(image_path):
+        chat = AsyncChat(model_id, bedrock_runtime_client, limiter)
+        if analyze:
+            chat.add_user_message_image(prompt_analyze, load_image(image_path, encoder)) # analyze image
+            await chat.generate_async()
+            chat.add_user_message(text_prompt)                                          # answer about the analyzed image
+        else:
+            chat.add_user_message_image(classification_prompt, load_image(image_path, encoder))
+        return await chat.generate_async()
+
+    return vote_fn
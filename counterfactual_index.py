@@ -0,0 +1,185 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+
+def concept_counts(concepts):
+    # concept -> number of objects of the row holding it
+    return Counter(c for obj in concepts for c in obj)
+
+
+def concept_count_bound(source_counts, target_counts):
+    """
+    Lower bound of the cece edit cost between two rows.
+
+    find_edits pads the shorter row with empty objects and matches the objects of the two rows so that
+    the sum of the symmetric differences of the matched concept sets is minimal (an addition or a
+    removal costs the size of the object). Whatever the matching, a concept held by n objects of one
+    row and m of the other is in at least abs(n - m) of the symmetric differences, so the L1 distance
+    of the concept counts never exceeds the cost.
+    """
+    bound = 0
+    for c, n in source_counts.items():
+        bound += abs(n - target_counts.get(c, 0))
+    for c, m in target_counts.items():
+        if c not in source_counts:
+            bound += m
+    return bound
+
+
+class CounterfactualIndex:
+    """
+    Pruned nearest-counterfactual search over the rows of an xDataset.
+
+    ds.explain scans the whole dataset for the minimum-cost row of a different label. Here rows
+    with identical concept sets are merged, an inverted index over the concepts (WordNet synsets
+    and surface words) ranks the targets sharing concepts with the source by overlap, and the
+    remaining targets follow by difference in number of objects. Only the candidates whose lower
+    bound (see concept_count_bound) can beat the best cost found so far are costed with find_edits,
+    and the size-ordered tail stops once the objects to add or remove alone cost more. Results are
+    cached per distinct source and label, so explain_all reuses work across duplicate frames.
+
+    The minimum cost is the one of ds.explain; among targets of equal cost the lowest row index is
+    returned, whatever the order in which they were costed.
+
+    Args:
+        ds (xDataset): Dataset providing find_edits.
+        labels (list): Label of each row of ds.dataset.
+        n_candidates (int, optional): Caps the exact edit costs computed per query to the best
+            ranked candidates, a heuristic that can miss the minimum. None (the default) keeps the
+            exact minimum.
+        lower_bound (bool): Prune with the bounds of cece's cost model. False costs every candidate,
+            for a find_edits with another cost function.
+    """
+
+    def __init__(self, ds, labels, n_candidates = None, lower_bound = True):
+        self.ds = ds
+        self.labels = labels
+        self.n_candidates = n_candidates
+        self.lower_bound = lower_bound
+        self.cache = {}
+        self.exact_calls = 0
+
+        # group the rows with the same concepts, they have the same edit cost to any other row
+        self.row_group = []
+        self.group_rows = []
+        group_of_key = {}
+        for i, row in enumerate(ds.dataset):
+            key = tuple(sorted(tuple(sorted(c)) for c in row.concepts))
+            if key not in group_of_key:
+                group_of_key[key] = len(self.group_rows)
+                self.group_rows.append([])
+            self.row_group.append(group_of_key[key])
+            self.group_rows[group_of_key[key]].append(i)
+
+        self.group_size = []
+        self.group_concepts = []
+        self.group_counts = []
+        self.group_labels = []
+        self.postings = defaultdict(list)
+        # smallest object, an object added or removed costs at least that much
+        self.min_object_cost = min((len(obj) for row in ds.dataset for obj in row.concepts), default=0)
+        for g, rows in enumerate(self.group_rows):
+            concepts = set().union(*ds.dataset[rows[0]].concepts)
+            self.group_size.append(len(ds.dataset[rows[0]].concepts))
+            self.group_counts.append(concept_counts(ds.dataset[rows[0]].concepts))
+            self.group_concepts.append(len(concepts))
+            self.group_labels.append({labels[i] for i in rows})
+            for c in concepts:
+                self.postings[c].append(g)
+
+        # groups by number of objects, to visit the groups sharing no concept with the source
+        # from the closest size outwards
+        self.size_order = sorted(range(len(self.group_rows)), key=lambda g: self.group_size[g])
+        self.sorted_sizes = [self.group_size[g] for g in self.size_order]
+
+    def target_row(self, group, label):
+        # first row of the group whose label differs from the source label, the source group
+        # itself is a candidate when identical frames carry different labels
+        for i in self.group_rows[group]:
+            if self.labels[i] != label:
+                return i
+        return None
+
+    def candidates(self, source_group, label):
+        """
+        Yields (group, size_ordered) for the groups holding a row of another label: first the groups
+        reached through the postings of the source concepts, by decreasing Jaccard overlap, then the
+        others by increasing difference in number of objects (size_ordered True). Only the groups
+        sharing a concept are sorted, the others are walked lazily from the sorted sizes.
+        """
+        overlap = defaultdict(int)
+        for c in set().union(*self.ds.dataset[self.group_rows[source_group][0]].concepts):
+            for g in self.postings[c]:
+                overlap[g] += 1
+
+        n_source = self.group_concepts[source_group]
+        size = self.group_size[source_group]
+        ranked = []
+        for g, o in overlap.items():
+            if self.group_labels[g] <= {label}:
+                continue
+            jaccard = o / (n_source + self.group_concepts[g] - o)
+            ranked.append((-jaccard, abs(size - self.group_size[g]), g))
+        ranked.sort()
+        for _, _, g in ranked:
+            yield g, False
+
+        hi = bisect_left(self.sorted_sizes, size)
+        lo = hi - 1
+        while lo >= 0 or hi < len(self.size_order):
+            if hi >= len(self.size_order) or (lo >= 0 and size - self.sorted_sizes[lo] <= self.sorted_sizes[hi] - size):
+                g = self.size_order[lo]
+                lo -= 1
+            else:
+                g = self.size_order[hi]
+                hi += 1
+            if g in overlap or self.group_labels[g] <= {label}:
+                continue
+            yield g, True
+
+    def explain(self, source_index, label):
+        """
+        Returns:
+            tuple: (target_index, cost, edits), edits as returned by ds.find_edits, so no second
+                find_edits call is needed. (None, None, None) if no row has a different label.
+        """
+        source_group = self.row_group[source_index]
+        key = (source_group, label)
+        if key in self.cache:
+            return self.cache[key]
+
+        source = self.ds.dataset[source_index]
+        size = self.group_size[source_group]
+        source_counts = self.group_counts[source_group]
+        best = (None, None, None)
+        evaluated = 0
+        for g, size_ordered in self.candidates(source_group, label):
+            if self.n_candidates is not None and evaluated >= self.n_candidates:
+                break
+            target_index = self.target_row(g, label)
+            if self.lower_bound and best[1] is not None:
+                if size_ordered and abs(size - self.group_size[g]) * self.min_object_cost > best[1]:
+                    # the remaining groups differ by at least as many objects
+                    break
+                bound = concept_count_bound(source_counts, self.group_counts[g])
+                if (bound, target_index) > (best[1], best[0]):
+                    continue
+            cost, edits = self.ds.find_edits(source, self.ds.dataset[target_index])
+            evaluated += 1
+            self.exact_calls += 1
+            if best[1] is None or (cost, target_index) < (best[1], best[0]):
+                best = (target_index, cost, edits)
+
+        self.cache[key] = best
+        return best
+
+    def explain_all(self, indices = None):
+        """
+        Explains every row (or the given indices) against its own label.
+
+        Returns:
+            dict: index -> (target_index, cost, edits)
+        """
+        if indices is None:
+            indices = range(len(self.labels))
+        return {i: self.explain(i, self.labels[i]) for i in indices}
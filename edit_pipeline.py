@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tqdm import tqdm
+
+
+# Pipelined runner for the edit loops. Each image's edit loop is written as a generator that
+# yields a Task whenever it needs an LVLM answer, an inpainting or a classification, e.g.
+#
+#   def edit_job(image_id):
+#       ...
+#       background = yield Task("lvlm", ask_lvlm, chat, prompt, source_image_path)
+#       new_image, mask = yield Task("inpaint", editor.replacer, source_image_path, obj, background)
+#       new_image.save(step_path)
+#       new_label = yield Task("classify", classifier.classify, step_path)
+#       ...
+#       return steps
+#
+# The runner advances many such state machines at once, so while Bedrock answers one image the
+# webui inpaints another and the classifier scores a third, and throughput approaches the slowest stage.
+# run_inline runs the same generator sequentially, for a single image.
+
+
+STAGES = ("lvlm", "inpaint", "classify")
+
+
+class Task:
+
+    def __init__(self, stage, fn, *args, **kwargs):
+        self.stage = stage
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.fn(*self.args, **self.kwargs)
+
+
+def run_inline(gen):
+    # runs an edit-loop generator in the calling thread, one task after the other, and returns its result
+    value, error = None, None
+    while True:
+        try:
+            task = gen.throw(error) if error is not None else gen.send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = task(), None
+        except Exception as e:
+            value, error = None, e
+
+
+class EditPipeline:
+    """
+    Runs edit-loop generators concurrently with one bounded worker pool per stage.
+
+    Tasks beyond the workers of a stage wait in that stage's queue, and new images are only
+    started while fewer than max_active are in progress, which bounds memory and applies
+    backpressure to the faster stages.
+
+    Args:
+        workers (dict): Number of workers per stage, e.g. {"lvlm": 16, "inpaint": 2, "classify": 4}.
+            Every stage must be one of STAGES, a stage left out gets no workers.
+        max_active (int, optional): Maximum number of images in progress, defaults to twice the total workers.
+    """
+
+    def __init__(self, workers = None, max_active = None):
+        self.workers = workers or {"lvlm": 16, "inpaint": 2, "classify": 4}
+        for stage, n in self.workers.items():
+            if stage not in STAGES:
+                raise ValueError(f"Unknown stage {stage!r}, expected one of {STAGES}")
+            if n < 1:
+                raise ValueError(f"Stage {stage!r} needs at least one worker, got {n}")
+        self.max_active = max_active or 2 * sum(self.workers.values())
+        self.executors = {stage: ThreadPoolExecutor(max_workers=n, thread_name_prefix=stage) for stage, n in self.workers.items()}
+        self.in_flight = defaultdict(int)
+        self.queued = defaultdict(deque)
+        self.busy_time = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.stats_lock = threading.Lock()
+
+    def _timed(self, stage, task):
+        start = time.perf_counter()
+        try:
+            return task()
+        finally:
+            with self.stats_lock:
+                self.busy_time[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+
+    def _submit(self, futures, key, gen, task):
+        if self.in_flight[task.stage] >= self.workers[task.stage]:
+            self.queued[task.stage].append((key, gen, task))
+            return
+        self.in_flight[task.stage] += 1
+        future = self.executors[task.stage].submit(self._timed, task.stage, task)
+        futures[future] = (key, gen, task.stage)
+
+    def _advance(self, futures, results, key, gen, value = None, error = None):
+        # resume the generator with the result of its last task until it yields the next one
+        try:
+            task = gen.throw(error) if error is not None else gen.send(value)
+        except StopIteration as stop:
+            results[key] = stop.value
+            return False
+        except Exception as e:
+            results[key] = e
+            return False
+        if task.stage not in self.executors:
+            # only this image fails, the others keep running
+            results[key] = ValueError(f"Task of unknown stage {task.stage!r}, the pipeline runs {list(self.executors)}")
+            gen.close()
+            return False
+        self._submit(futures, key, gen, task)
+        return True
+
+    def run(self, jobs, progress = True):
+        """
+        Args:
+            jobs (iterable): (key, generator) pairs, one per image.
+            progress (bool): Show a tqdm bar over the finished images.
+
+        Returns:
+            dict: key -> value returned by the generator, or the exception that stopped it.
+        """
+        jobs = iter(jobs)
+        futures, results = {}, {}
+        active, exhausted = 0, False
+        bar = tqdm(disable=not progress)
+
+        while True:
+            while not exhausted and active < self.max_active:
+                try:
+                    key, gen = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if self._advance(futures, results, key, gen):
+                    active += 1
+                else:
+                    bar.update(1)
+
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, gen, stage = futures.pop(future)
+                self.in_flight[stage] -= 1
+                if self.queued[stage]:
+                    self._submit(futures, *self.queued[stage].popleft())
+
+                error = future.exception()
+                if not self._advance(futures, results, key, gen, None if error else future.result(), error):
+                    active -= 1
+                    bar.update(1)
+
+        bar.close()
+        return results
+
+    def stage_stats(self):
+        # total busy seconds and calls per stage, the stage with the highest busy time per worker is the bottleneck
+        return {stage: {"calls": self.calls[stage],
+                        "busy_seconds": self.busy_time[stage],
+                        "busy_per_worker": self.busy_time[stage] / self.workers[stage]}
+                for stage in self.workers}
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
@@ -0,0 +1,363 @@
+import ast
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from run_log import label_changed
+
+
+# Beam search over edits. Instead of applying one edit at a time and classifying after each, every
+# round expands the B best paths with several candidate next edits, renders all the candidates in
+# one batch of inpainting requests, scores them with one batched classifier forward pass and keeps
+# the B paths closest to a label flip:
+#
+#   proposer = GlobalEditProposer(global_edits, objs, ask_lvlm, prompt_remove_object, prompt_add_object)
+#   search = BeamSearch(editor, proposer, bdd_scorer(classifier, orig_label), beam_width=3, branching=3)
+#   result = search.search(source_image_path, run_dir, orig_label, run_log)
+
+
+class Candidate:
+    """
+    A path of edits from the source image.
+
+    Args:
+        image_path (str): Image after the last edit of the path.
+        steps (list): The edits, e.g. [["remove", "car", "road"], ...].
+        state: Proposer state after the path (e.g. the objects still in the image).
+        label: Classification of image_path.
+        score (float): How close image_path is to a label flip, higher is closer.
+        lvlm (list): {"prompt", "output"} of the LVLM call that produced each edit.
+        images (list): Image of each edit.
+        labels (list): Classification of each edit.
+        prompts (tuple): (detection_prompt, positive_prompt) of the last edit, until it is rendered.
+    """
+
+    def __init__(self, image_path, steps, state, label = None, score = -np.inf, lvlm = None, images = None,
+                 labels = None, prompts = None, parent_image = None):
+        self.image_path = image_path
+        self.steps = steps
+        self.state = state
+        self.label = label
+        self.score = score
+        self.lvlm = lvlm or []
+        self.images = images or []
+        self.labels = labels or []
+        self.prompts = prompts
+        self.parent_image = parent_image
+
+    def key(self):
+        # paths applying the same edits in a different order are expanded only once
+        return frozenset(tuple(step) for step in self.steps)
+
+
+class GlobalEditProposer:
+    """
+    Candidate next edits from the global explanation, in its order: removals of objects in the image
+    (v <= 0) and additions of missing ones (v > 0), as in edit_global_edits. Every candidate needs one
+    LVLM answer (the background or the object description), asked in a new conversation.
+
+    Args:
+        global_edits (dict): Object -> weight, from global_explanations.
+        objs (list): Objects of the source image.
+        ask (callable): ask(prompt, image_path) -> LVLM answer.
+        prompt_remove (callable): prompts.prompt_remove_object.
+        prompt_add (callable): prompts.prompt_add_object.
+    """
+
+    def __init__(self, global_edits, objs, ask, prompt_remove, prompt_add):
+        self.global_edits = global_edits
+        self.objs = objs
+        self.ask = ask
+        self.prompt_remove = prompt_remove
+        self.prompt_add = prompt_add
+
+    def initial_state(self):
+        # objects already edited on the path
+        return frozenset()
+
+    def _remove(self, obj, node):
+        prompt = self.prompt_remove(obj)
+        background = self.ask(prompt, node.image_path)
+        return [(["remove", obj, background.strip()], (obj, background.strip()),
+                 node.state | {obj}, {"prompt": prompt, "output": background})]
+
+    def _add(self, obj, node):
+        prompt = self.prompt_add(obj)
+        add = self.ask(prompt, node.image_path)
+        return [(["add", obj, add.strip()], (add.strip(), obj),
+                 node.state | {obj}, {"prompt": prompt, "output": add})]
+
+    def __call__(self, node, branching):
+        asks = []
+        for obj, v in self.global_edits.items():
+            if len(asks) == branching:
+                break
+            if obj in node.state:
+                continue
+            if v <= 0 and obj in self.objs:
+                asks.append(lambda obj=obj: self._remove(obj, node))
+            elif v > 0 and obj not in self.objs:
+                asks.append(lambda obj=obj: self._add(obj, node))
+        return asks
+
+
+class SingleStepProposer:
+    """
+    Candidate next edits from the LVLM, as in edit_claude_single_step, but asking for several
+    alternative steps in one answer (one list per line) instead of one step per round trip.
+
+    Args:
+        ask (callable): ask(prompt, image_path) -> LVLM answer.
+        prompt_fn (callable): prompt_fn(objs, added_objs, removed_objs), e.g. prompt_single_step_bdd100k.
+        objs, added_objs, removed_objs (list): From get_local_edits.
+    """
+
+    ALTERNATIVES = """
+Give me {n} different alternatives for this step, each one on its own line in the same format, best first.
+"""
+
+    def __init__(self, ask, prompt_fn, objs, added_objs, removed_objs):
+        self.ask = ask
+        self.prompt_fn = prompt_fn
+        self.objs = objs
+        self.added_objs = added_objs
+        self.removed_objs = removed_objs
+
+    def initial_state(self):
+        return (tuple(self.objs), tuple(self.added_objs), tuple(self.removed_objs))
+
+    @staticmethod
+    def apply(step, state):
+        # the bookkeeping of edit_claude_single_step after an edit
+        objs, added_objs, removed_objs = (list(s) for s in state)
+        action = step[0].lower()
+        if action == "add":
+            if step[1] in added_objs:
+                added_objs.remove(step[1])
+            objs.append(step[1])
+            prompts = (step[2], step[1])
+        elif action in ("remove", "replace"):
+            if action == "replace":
+                if step[2] in added_objs:
+                    added_objs.remove(step[2])
+                objs.append(step[2])
+            if step[1] in removed_objs:
+                removed_objs.remove(step[1])
+            if step[1] in objs:
+                objs.remove(step[1])
+            prompts = (step[1], step[2])
+        else:
+            raise ValueError(f"Unknown action {step[0]!r}")
+        return prompts, (tuple(objs), tuple(added_objs), tuple(removed_objs))
+
+    @staticmethod
+    def parse(output, n):
+        steps = []
+        for line in output.split("\n"):
+            line = line.split("-")[0].strip()
+            try:
+                step = ast.literal_eval(line)
+            except (ValueError, SyntaxError):
+                continue
+            if isinstance(step, (list, tuple)) and len(step) == 3 and list(step) not in steps:
+                steps.append(list(step))
+        return steps[:n]
+
+    def _ask(self, node, branching):
+        objs, added_objs, removed_objs = (list(s) for s in node.state)
+        prompt = self.prompt_fn(objs, added_objs, removed_objs) + self.ALTERNATIVES.format(n=branching)
+        output = self.ask(prompt, node.image_path)
+        candidates = []
+        for step in self.parse(output, branching):
+            try:
+                prompts, state = self.apply(step, node.state)
+            except ValueError:
+                continue
+            candidates.append((step, prompts, state, {"prompt": prompt, "output": output}))
+        return candidates
+
+    def __call__(self, node, branching):
+        return [lambda: self._ask(node, branching)]
+
+
+def bdd_scorer(classifier, orig_label):
+    """
+    Batched scorer for BDD100k_classifier: the score is the logit of the queried label, negated when
+    the source is positive, so it grows as the image moves towards the other class.
+    """
+    def score(paths):
+        labels, logits = classifier.classify_batch(paths, batch_size=len(paths), num_workers=0)
+        margin = logits.reshape(len(paths), -1)[:, 0]
+        return [int(l) for l in labels], (-margin if orig_label == 1 else margin)
+    return score
+
+
+def places_scorer(classifier, orig_label, top_k = 5):
+    """
+    Batched scorer for the places365 Classifier: the score is 1 - the probability of the original
+    top class (0 if it left the top_k). The labels are [[class_name, prob], ...] lists as in classify.
+    """
+    orig_class = orig_label[0][0] if isinstance(orig_label, list) else orig_label
+
+    def score(paths):
+        idx, probs = classifier.classify_many(paths, top_k, batch_size=len(paths))
+        labels = classifier.labels(idx, probs)
+        scores = np.array([1.0 - dict(map(tuple, label)).get(orig_class, 0.0) for label in labels])
+        return labels, scores
+    return score
+
+
+def label_scorer(classify, orig_label, max_workers = 8):
+    # any classify(image_path) (e.g. the LVLM voting one), run concurrently, the score is 1 for a flip
+    def score(paths):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            labels = list(executor.map(classify, paths))
+        return labels, np.array([float(label_changed(orig_label, label)) for label in labels])
+    return score
+
+
+class BeamSearch:
+    """
+    Keeps the beam_width best edit paths and expands each of them with up to branching candidate
+    edits per round, for at most max_depth rounds or until a candidate flips the label.
+
+    Per round the LVLM answers of all the candidates are asked concurrently (lvlm_workers at a time)
+    and the rendered candidates are scored with one call of the scorer. The inpaintings are not
+    batched: editor.replacer_many sends one replacer request per candidate, with at most the
+    concurrency of the Editor (or of every endpoint of an EditorPool) in flight. A single webui
+    renders them one after the other, so the inpainting of a round costs about
+    candidates / (number of endpoints) inpainting latencies, beam_width * branching with one Editor.
+
+    Args:
+        editor (Editor or EditorPool): Renders the candidates.
+        proposer (callable): proposer(node, branching) -> list of zero-argument calls, each returning
+            (step, (detection_prompt, positive_prompt), state, lvlm_call) tuples, e.g. GlobalEditProposer.
+        scorer (callable): scorer(paths) -> (labels, scores), e.g. bdd_scorer.
+        changed_fn (callable): changed_fn(orig_label, label), True when the label flipped.
+    """
+
+    def __init__(self, editor, proposer, scorer, beam_width = 3, branching = 3, max_depth = 5,
+                 changed_fn = label_changed, lvlm_workers = 16):
+        self.editor = editor
+        self.proposer = proposer
+        self.scorer = scorer
+        self.beam_width = beam_width
+        self.branching = branching
+        self.max_depth = max_depth
+        self.changed_fn = changed_fn
+        self.lvlm_workers = lvlm_workers
+        self.stats = {"rounds": 0, "lvlm_calls": 0, "rendered": 0, "failed": 0}
+
+    def _propose(self, beam, run_log):
+        # (parent, ask) for every candidate call of the beam, all asked concurrently
+        asks = [(node, ask) for node in beam for ask in self.proposer(node, self.branching)]
+        self.stats["lvlm_calls"] += len(asks)
+
+        def run(item):
+            node, ask = item
+            try:
+                return node, ask()
+            except Exception as e:
+                return node, e
+
+        with _timer(run_log, "lvlm"), ThreadPoolExecutor(max_workers=self.lvlm_workers) as executor:
+            answers = list(executor.map(run, asks))
+
+        children, seen = [], set()
+        for node, answer in answers:
+            if isinstance(answer, Exception):
+                self._failed(answer)
+                continue
+            for step, prompts, state, lvlm_call in answer:
+                child = Candidate(None, node.steps + [step], state, lvlm=node.lvlm + [lvlm_call], images=list(node.images),
+                                  labels=list(node.labels), prompts=prompts, parent_image=node.image_path)
+                if child.key() not in seen:
+                    seen.add(child.key())
+                    children.append(child)
+        return children
+
+    def _failed(self, e):
+        # a failed candidate is dropped, it is not an exception of the run (the parsers skip those)
+        self.stats["failed"] += 1
+        print(f"Candidate failed: {e}")
+
+    def search(self, source_image_path, run_dir, orig_label, run_log = None):
+        """
+        Args:
+            source_image_path (str): The source image, classified as orig_label.
+            run_dir (str): Folder of the run, the candidates are saved in run_dir/beam and the images
+                of the returned path are copied to run_dir/step_i.jpg like the sequential loops do.
+            run_log (RunLogger, optional): Gets the stage timings and the steps of the path.
+
+        Returns:
+            Candidate: The first path that flips the label (the best scored if several flip in the
+                same round), or the best scored path when none did.
+        """
+        beam_dir = os.path.join(run_dir, "beam")
+        os.makedirs(beam_dir, exist_ok=True)
+        root = Candidate(source_image_path, [], self.proposer.initial_state(), orig_label)
+        beam, best = [root], root
+
+        for depth in range(1, self.max_depth + 1):
+            self.stats["rounds"] += 1
+            children = self._propose(beam, run_log)
+            if not children:
+                break
+
+            with _timer(run_log, "inpaint"):
+                results = self.editor.replacer_many([(c.parent_image, *c.prompts) for c in children])
+            rendered = []
+            for n, (child, result) in enumerate(zip(children, results)):
+                if isinstance(result, Exception):
+                    self._failed(result)
+                    continue
+                child.image_path = os.path.join(beam_dir, f"{depth}_{n}.jpg")
+                result[0].save(child.image_path)
+                child.images.append(child.image_path)
+                rendered.append(child)
+            self.stats["rendered"] += len(rendered)
+            if not rendered:
+                break
+
+            with _timer(run_log, "classify"):
+                labels, scores = self.scorer([c.image_path for c in rendered])
+            for child, label, score in zip(rendered, labels, scores):
+                child.label = label
+                child.score = float(score)
+                child.labels.append(label)
+
+            rendered.sort(key=lambda c: c.score, reverse=True)
+            flipped = [c for c in rendered if self.changed_fn(orig_label, c.label)]
+            if flipped:
+                best = flipped[0]
+                break
+            beam = rendered[:self.beam_width]
+            if beam[0].score > best.score:
+                best = beam[0]
+
+        self._write_path(best, run_dir, run_log)
+        return best
+
+    def _write_path(self, node, run_dir, run_log):
+        # step_i.jpg and run log records of the kept path, so the parsers and ResultIndex read it as a normal run
+        for i, (step, image, label, lvlm_call) in enumerate(zip(node.steps, node.images, node.labels, node.lvlm), 1):
+            step_path = os.path.join(run_dir, f"step_{i}.jpg")
+            shutil.copyfile(image, step_path)
+            if run_log is not None:
+                run_log.lvlm(lvlm_call["prompt"], lvlm_call["output"])
+                run_log.step(i, step, label, step_path)
+
+
+class _NoTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _timer(run_log, stage):
+    return run_log.timer(stage) if run_log is not None else _NoTimer()
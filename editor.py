@@ -1,16 +1,61 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
 import webuiapi
 from PIL import Image
 import matplotlib.pyplot as plt
 
+NEGATIVE_PROMPT = "cartoon, unrealistic proportions, blurry edges, low detail, overexposed lighting, distorted shapes"
+
+
+def _gather(calls, max_workers):
+    # results of the calls in order, an exception takes the place of the result of a failed call
+    def run(call):
+        try:
+            return call()
+        except Exception as e:
+            return e
+    if max_workers == 1 or len(calls) < 2:
+        return [run(call) for call in calls]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, calls))
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    # webuiapi sends its requests without a timeout, the adapter of the api session adds one
+
+    def __init__(self, timeout = None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
 class Editor():
 
-    def __init__(self, gradio_link):
+    def __init__(self, gradio_link, steps = 40, use_hires_fix = True, concurrency = 1, timeout = (10, 600)):
         self.gradio_link = gradio_link  
         self.api = webuiapi.WebUIApi(host=self.gradio_link , port=7860, baseurl=f"{self.gradio_link}/replacer")
         # create API client with custom host, port
         # api = webuiapi.WebUIApi()
+        self.steps = steps
+        self.use_hires_fix = use_hires_fix
+        self.concurrency = max(1, concurrency)
 
-    def replacer(self, image_path, detection_prompt, positive_prompt, negative_prompt = "cartoon, unrealistic proportions, blurry edges, low detail, overexposed lighting, distorted shapes", extra_include= ["mask"]):
+        # keep-alive: the api session reuses its connections, sized for the concurrent requests.
+        # timeout is (connect, read) seconds, a hung webui raises requests.exceptions.Timeout
+        adapter = TimeoutHTTPAdapter(timeout, pool_connections=1, pool_maxsize=max(1, concurrency))
+        self.api.session.mount("http://", adapter)
+        self.api.session.mount("https://", adapter)
+
+    def replacer(self, image_path, detection_prompt, positive_prompt, negative_prompt = NEGATIVE_PROMPT, extra_include= ["mask"]):
 
         # load image 
         img = Image.open(image_path)
@@ -23,9 +68,136 @@ class Editor():
                                     mask_blur= 10,
                                     cfg_scale= 10,
                                     denoise= 1,
-                                    steps= 40,
-                                    use_hires_fix= True,
+                                    steps= self.steps,
+                                    use_hires_fix= self.use_hires_fix,
                                     
                     )
 
         return result.image, result.extra_images[0]
+
+    async def replacer_async(self, *args, **kwargs):
+        return await asyncio.to_thread(self.replacer, *args, **kwargs)
+
+    def replacer_many(self, requests_args):
+        """
+        Runs several replacer requests at once (up to concurrency in flight on the kept-alive session).
+
+        Args:
+            requests_args (list): (image_path, detection_prompt, positive_prompt) tuples.
+
+        Returns:
+            list: (image, mask) of every request in order, or the exception it raised.
+        """
+        return _gather([lambda a=a: self.replacer(*a) for a in requests_args], self.concurrency)
+
+    def is_healthy(self, timeout = 10):
+        # A1111 answers /internal/ping as soon as the server is up
+        try:
+            response = self.api.session.get(f"{self.gradio_link}/internal/ping", timeout=timeout)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+
+class EditorPool():
+    """
+    Drives several webui endpoints (e.g. one A1111 instance per GPU) behind the Editor API.
+
+    Requests wait in a queue until an endpoint has a free slot and go to the least loaded healthy
+    endpoint. An endpoint that fails with a connection error is marked unhealthy and the request
+    fails over to the next one; unhealthy endpoints are probed again after health_check_interval.
+
+    Args:
+        gradio_links (list): Links of the webui servers.
+        per_endpoint_concurrency (int): Concurrent requests sent to each endpoint.
+        health_check_interval (float): Seconds before an unhealthy endpoint is checked again.
+        **kwargs: Editor arguments (steps, use_hires_fix, timeout). A request that times out fails
+            over like a connection error.
+    """
+
+    def __init__(self, gradio_links, per_endpoint_concurrency = 1, health_check_interval = 30, **kwargs):
+        self.editors = [Editor(link, concurrency=per_endpoint_concurrency, **kwargs) for link in gradio_links]
+        self.per_endpoint_concurrency = per_endpoint_concurrency
+        self.health_check_interval = health_check_interval
+        self.load = [0] * len(self.editors)
+        self.healthy = [True] * len(self.editors)
+        self.last_failure = [0.0] * len(self.editors)
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.editors) * per_endpoint_concurrency)
+
+    def _revive(self):
+        # the endpoints due for a probe are claimed under the lock (so only one thread probes each),
+        # the probes themselves run outside of it
+        with self.condition:
+            now = time.time()
+            due = [i for i in range(len(self.editors))
+                   if not self.healthy[i] and now - self.last_failure[i] >= self.health_check_interval]
+            for i in due:
+                self.last_failure[i] = now
+        for i in due:
+            if self.editors[i].is_healthy():
+                with self.condition:
+                    self.healthy[i] = True
+                    self.condition.notify_all()
+
+    def _free_endpoint(self, exclude):
+        candidates = [i for i in range(len(self.editors))
+                      if self.healthy[i] and i not in exclude and self.load[i] < self.per_endpoint_concurrency]
+        return min(candidates, key=lambda i: self.load[i]) if candidates else None
+
+    def _acquire(self, exclude):
+        while True:
+            self._revive()
+            with self.condition:
+                if not any(self.healthy[i] and i not in exclude for i in range(len(self.editors))):
+                    return None
+                endpoint = self._free_endpoint(exclude)
+                if endpoint is not None:
+                    self.load[endpoint] += 1
+                    return endpoint
+                self.condition.wait(timeout=self.health_check_interval)
+
+    def _release(self, endpoint, failed):
+        with self.condition:
+            self.load[endpoint] -= 1
+            if failed:
+                self.healthy[endpoint] = False
+                self.last_failure[endpoint] = time.time()
+            self.condition.notify_all()
+
+    def replacer(self, *args, **kwargs):
+        tried = set()
+        while True:
+            endpoint = self._acquire(tried)
+            if endpoint is None:
+                raise ConnectionError(f"No healthy webui endpoint left, tried {[self.editors[i].gradio_link for i in tried]}")
+            try:
+                result = self.editors[endpoint].replacer(*args, **kwargs)
+            except requests.exceptions.RequestException as e:
+                print(f"Endpoint {self.editors[endpoint].gradio_link} failed: {e}")
+                self._release(endpoint, failed=True)
+                tried.add(endpoint)
+                continue
+            except Exception:
+                self._release(endpoint, failed=False)
+                raise
+            self._release(endpoint, failed=False)
+            return result
+
+    def submit(self, *args, **kwargs):
+        # returns a concurrent.futures.Future of replacer(*args, **kwargs)
+        return self.executor.submit(self.replacer, *args, **kwargs)
+
+    async def replacer_async(self, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(*args, **kwargs))
+
+    def replacer_many(self, requests_args):
+        # same as Editor.replacer_many, spread over the endpoints of the pool
+        futures = [self.submit(*a) for a in requests_args]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
@@ -0,0 +1,167 @@
+import csv
+import os
+import shutil
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from result_index import ResultIndex
+
+
+MANIFEST_FIELDS = ['run', 'original_classification', 'final_classification', 'number_of_steps',
+                   'source_path', 'counterfactual_path', 'run_source_path', 'run_counterfactual_path']
+
+
+def link_or_copy(src, dst):
+    # a hardlink shares the image bytes with the run folder, copy when linking is not possible
+    # (other filesystem, no hardlink support)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def up_to_date(src, dst):
+    # dst is the current src: its hardlink, or a copy2 of it (same size and mtime)
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def relink(src, dst):
+    # replaces dst by src, or leaves it when it is already up to date
+    if up_to_date(src, dst):
+        return False
+    if os.path.lexists(dst):
+        os.remove(dst)
+    link_or_copy(src, dst)
+    return True
+
+
+def default_manifest_path(step_output_directory):
+    # next to the output folder and not in it, the FID/CMMD tools read that folder as images only
+    step_output_directory = os.path.abspath(step_output_directory)
+    return os.path.join(os.path.dirname(step_output_directory), f"{os.path.basename(step_output_directory)}_manifest.csv")
+
+
+def read_manifest_rows(manifest_path):
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, newline="") as handle:
+        return list(csv.DictReader(handle))
+
+
+def unique_name(filename, taken):
+    # same renaming as the parsers (name_1.jpg, name_2.jpg, ...) but against an in-memory set of
+    # the names in the output folder instead of probing the filesystem
+    if filename not in taken:
+        taken.add(filename)
+        return filename
+    base_name, ext = os.path.splitext(filename)
+    counter = 1
+    while f"{base_name}_{counter}{ext}" in taken:
+        counter += 1
+    filename = f"{base_name}_{counter}{ext}"
+    taken.add(filename)
+    return filename
+
+
+def collect_counterfactuals(base_directory, step_output_directory, source_output_directory, changed_fn,
+                            skip_exceptions = False, manifest_path = None, max_workers = None, index_path = None):
+    """
+    Collects the source and final step images of the runs whose classification changed.
+
+    The runs come from the result_index.ResultIndex of base_directory, parsed in a process pool;
+    with an index_path only the new or changed run folders are parsed again. The images are
+    hardlinked into the output folders with the names used by the parsers ({run}_cf.jpg and
+    {run}_source.jpg) and every collected pair is written to a CSV manifest, so the pairing does
+    not have to be recovered from the filenames.
+
+    Collecting again is idempotent: a run already in the manifest keeps its output files, which are
+    only replaced when its images changed, and the files of the runs that are no longer
+    counterfactuals are removed from the output folders.
+
+    Args:
+        base_directory (str): Folder with one subfolder per run.
+        step_output_directory (str): Where the counterfactual (final step) images are stored.
+        source_output_directory (str): Where the source images are stored.
+        changed_fn (callable): changed_fn(original_classification, final_classification) is True
+            if the run is a counterfactual.
+        skip_exceptions (bool): Discard the runs that logged an exception.
+        manifest_path (str, optional): CSV file of the pairs, defaults to
+            <step_output_directory>_manifest.csv next to step_output_directory (not inside it).
+        max_workers (int, optional): Processes used to index the changed runs.
+        index_path (str, optional): Index file kept between calls, outside base_directory, see ResultIndex.
+
+    Returns:
+        list: The manifest rows (dicts with MANIFEST_FIELDS).
+    """
+    for directory in [step_output_directory, source_output_directory]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+            print(f"Created output directory at: {directory}")
+
+    if manifest_path is None:
+        manifest_path = default_manifest_path(step_output_directory)
+    taken = {step_output_directory: set(os.listdir(step_output_directory)),
+             source_output_directory: set(os.listdir(source_output_directory))}
+    # run -> row of the previous collection
+    previous = {row['run']: row for row in read_manifest_rows(manifest_path)}
+
+    index = ResultIndex.open(base_directory, index_path, max_workers)
+
+    rows, linked = [], 0
+    with open(manifest_path + ".tmp", "w", newline="") as handle:
+        writer = csv.DictWriter(handle, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        for record in index.counterfactuals(changed_fn, skip_exceptions):
+            name, number_of_steps = record['run'], record['number_of_steps']
+            if number_of_steps not in record['steps'] or record['source_path'] is None:
+                print(f"Missing step_{number_of_steps}.jpg or source.jpg in {record['path']}")
+                continue
+
+            step_image_path = os.path.join(record['path'], f"step_{number_of_steps}.jpg")
+            source_image_path = record['source_path']
+            if name in previous:
+                # same output files as the last collection
+                step_destination_path = previous[name]['counterfactual_path']
+                source_destination_path = previous[name]['source_path']
+            else:
+                step_destination_path = os.path.join(step_output_directory, unique_name(f"{name}_cf.jpg", taken[step_output_directory]))
+                source_destination_path = os.path.join(source_output_directory, unique_name(f"{name}_source.jpg", taken[source_output_directory]))
+            linked += relink(step_image_path, step_destination_path)
+            linked += relink(source_image_path, source_destination_path)
+
+            row = {'run': name,
+                   'original_classification': record['original_classification'],
+                   'final_classification': record['final_classification'],
+                   'number_of_steps': number_of_steps,
+                   'source_path': source_destination_path,
+                   'counterfactual_path': step_destination_path,
+                   'run_source_path': source_image_path,
+                   'run_counterfactual_path': step_image_path}
+            writer.writerow(row)
+            rows.append(row)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    collected = {row['run'] for row in rows}
+    for name, row in previous.items():
+        if name not in collected:
+            for path in [row['counterfactual_path'], row['source_path']]:
+                if os.path.lexists(path):
+                    os.remove(path)
+
+    print(f"Collected {len(rows)} counterfactual pairs ({linked} images linked), manifest at {manifest_path}")
+    return rows
+
+
+def read_manifest(manifest_path):
+    """
+    Returns:
+        list: (source_path, counterfactual_path) pairs, e.g. for PairedImageDataset(pairs=...).
+    """
+    with open(manifest_path, newline="") as handle:
+        return [(row['source_path'], row['counterfactual_path']) for row in csv.DictReader(handle)]
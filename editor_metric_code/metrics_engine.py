@@ -0,0 +1,382 @@
+import os
+import pickle
+import sys
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+from torch.utils import data
+from torchvision import transforms
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prediction_cache import file_hash
+from streaming_stats import GaussianStats, StreamingMetrics
+
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+CLIP_MEAN = [0.48145466, 0.4578275, 0.40821073]
+CLIP_STD = [0.26862954, 0.26130258, 0.27577711]
+
+
+class EmbeddingStore:
+    """
+    Per-image embeddings of one feature extractor, keyed by the content hash of the image.
+
+    The features live in a memory-mapped float32 .npy file (prefix.npy) that grows by doubling,
+    the hash -> row mapping in prefix.keys.pickle.
+
+    Args:
+        prefix (str): Path of the store without extension, e.g. "cache/inception".
+        dim (int): Embedding size.
+    """
+
+    def __init__(self, prefix, dim):
+        self.prefix = prefix
+        self.dim = dim
+        self.rows = {}
+        self.features = None
+        if os.path.exists(prefix + ".keys.pickle") and os.path.exists(prefix + ".npy"):
+            with open(prefix + ".keys.pickle", "rb") as handle:
+                self.rows = pickle.load(handle)
+            self.features = np.load(prefix + ".npy", mmap_mode="r+")
+            if self.features.shape[1] != dim:
+                raise ValueError(f"{prefix}.npy stores {self.features.shape[1]}-d features, expected {dim}")
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _reserve(self, n):
+        capacity = 0 if self.features is None else self.features.shape[0]
+        if n <= capacity:
+            return
+        grown = np.lib.format.open_memmap(self.prefix + ".tmp.npy", mode="w+", dtype=np.float32,
+                                          shape=(max(n, 2 * capacity, 1024), self.dim))
+        if capacity:
+            grown[:len(self.rows)] = self.features[:len(self.rows)]
+            del self.features
+        grown.flush()
+        del grown
+        os.replace(self.prefix + ".tmp.npy", self.prefix + ".npy")
+        self.features = np.load(self.prefix + ".npy", mmap_mode="r+")
+
+    def put(self, keys, features):
+        self._reserve(len(self.rows) + len(keys))
+        for key, feature in zip(keys, features):
+            row = self.rows.setdefault(key, len(self.rows))
+            self.features[row] = feature
+
+    def get(self, keys):
+        return np.asarray(self.features[[self.rows[k] for k in keys]])
+
+    def flush(self):
+        if self.features is not None:
+            self.features.flush()
+        with open(self.prefix + ".keys.pickle.tmp", "wb") as handle:
+            pickle.dump(self.rows, handle)
+        os.replace(self.prefix + ".keys.pickle.tmp", self.prefix + ".keys.pickle")
+
+
+class MultiTransformDataset(data.Dataset):
+    # decodes every image once and applies the transform of each extractor to it
+
+    def __init__(self, paths, transforms_list):
+        self.paths = paths
+        self.transforms_list = transforms_list
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        with Image.open(self.paths[idx]) as img:
+            img = img.convert('RGB')
+            return tuple(t(img) for t in self.transforms_list)
+
+
+class SimSiamExtractor:
+    """
+    SimSiam embeddings for S3.
+
+    s3_metric_custom scores a pair with the oracle of get_simsiam_dist, oracle(source, counterfactual),
+    the cosine similarity of the embeddings its .model gives to the two images. The embeddings of
+    oracle.model are cached per image instead, and S3 is the mean cosine similarity of the pairs;
+    verify checks that this matches the oracle on a few pairs before trusting the cached numbers.
+
+    Args:
+        oracle (torch.nn.Module): The get_simsiam_dist model (per-image encoder in oracle.model).
+        dim (int): Embedding size.
+    """
+
+    def __init__(self, oracle, dim = 2048, device = "cpu"):
+        if not hasattr(oracle, "model"):
+            raise TypeError("Expected the get_simsiam_dist oracle with a per-image encoder in .model, "
+                            "a pairwise-only oracle cannot be cached per image (use s3_metric_custom.compute_similarity)")
+        self.oracle = oracle.to(device).eval()
+        self.encoder = self.oracle.model
+        self.device = device
+        self.dims = {"simsiam": dim}
+        self.transform = transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+        ])
+
+    def __call__(self, batch):
+        return {"simsiam": self.encoder(batch.to(self.device)).flatten(1).cpu().numpy()}
+
+    @torch.inference_mode()
+    def verify(self, pairs, atol = 1e-4):
+        """
+        Compares the S3 of the per-image embeddings with the pairwise oracle.
+
+        Args:
+            pairs (list): A few (source_path, counterfactual_path) pairs.
+
+        Returns:
+            float: Largest absolute difference of the similarities, ValueError above atol.
+        """
+        def load(paths):
+            images = []
+            for path in paths:
+                with Image.open(path) as img:
+                    images.append(self.transform(img.convert('RGB')))
+            return torch.stack(images).float().to(self.device)
+
+        source, counterfactual = load([s for s, _ in pairs]), load([c for _, c in pairs])
+        expected = self.oracle(source, counterfactual).flatten().cpu().numpy()
+        cached = cosine_similarity(self(source)["simsiam"], self(counterfactual)["simsiam"])
+        difference = float(np.abs(expected - cached).max())
+        if difference > atol:
+            raise ValueError(f"Per-image SimSiam similarities differ from the oracle by up to {difference:.2e}")
+        return difference
+
+
+class InceptionExtractor:
+    """
+    InceptionV3 pool features (FID) and the first 7 channels of Mixed_6e (sFID) in one forward pass.
+
+    torchvision's ImageNet weights are used, so the values are comparable between our runs but not
+    to numbers computed with the TF FID Inception.
+    """
+
+    def __init__(self, device = "cpu"):
+        from torchvision.models import inception_v3, Inception_V3_Weights
+        self.model = inception_v3(weights=Inception_V3_Weights.DEFAULT, aux_logits=True)
+        self.model.fc = torch.nn.Identity()
+        self.model.to(device).eval()
+        self.device = device
+        self.dims = {"inception": 2048, "inception_spatial": 7 * 17 * 17}
+        self.spatial = None
+        self.model.Mixed_6e.register_forward_hook(self._keep_spatial)
+        self.transform = transforms.Compose([
+            transforms.Resize((299, 299)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+        ])
+
+    def _keep_spatial(self, module, inputs, output):
+        self.spatial = output[:, :7].flatten(1)
+
+    def __call__(self, batch):
+        pool = self.model(batch.to(self.device))
+        return {"inception": pool.cpu().numpy(), "inception_spatial": self.spatial.cpu().numpy()}
+
+
+class ClipExtractor:
+    # normalized CLIP image embeddings for CMMD, needs the transformers package
+
+    def __init__(self, model_name = "openai/clip-vit-large-patch14-336", image_size = 336, device = "cpu"):
+        from transformers import CLIPVisionModelWithProjection
+        self.model = CLIPVisionModelWithProjection.from_pretrained(model_name).to(device).eval()
+        self.device = device
+        self.dims = {"clip": self.model.config.projection_dim}
+        self.transform = transforms.Compose([
+            transforms.Resize(image_size, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.CenterCrop(image_size),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=CLIP_MEAN, std=CLIP_STD)
+        ])
+
+    def __call__(self, batch):
+        embeds = self.model(pixel_values=batch.to(self.device)).image_embeds
+        return {"clip": torch.nn.functional.normalize(embeds, dim=-1).cpu().numpy()}
+
+
+def cosine_similarity(x, y):
+    x = x / np.linalg.norm(x, axis=1, keepdims=True)
+    y = y / np.linalg.norm(y, axis=1, keepdims=True)
+    return (x * y).sum(axis=1)
+
+
+def gaussian_kernel(x, y, sigma = 10):
+    x, y = x.astype(np.float64), y.astype(np.float64)
+    x_sq, y_sq = (x * x).sum(axis=1), (y * y).sum(axis=1)
+    return np.exp(-(x_sq[:, None] + y_sq[None, :] - 2 * x @ y.T) / (2 * sigma ** 2))
+
+
+# The metrics read the stored embeddings chunk by chunk (chunks(keys) yields (chunk, dim) arrays),
+# so at most two chunks of features are in memory whatever the number of pairs.
+
+def streamed_s3(chunks, source_keys, counterfactual_keys):
+    total = 0.0
+    for s, c in zip(chunks(source_keys), chunks(counterfactual_keys)):
+        total += cosine_similarity(s, c).sum()
+    return float(total / len(source_keys))
+
+
+def streamed_frechet(chunks, source_keys, counterfactual_keys):
+    stats = []
+    for keys in [source_keys, counterfactual_keys]:
+        gaussian = None
+        for chunk in chunks(keys):
+            gaussian = gaussian or GaussianStats(chunk.shape[1])
+            gaussian.update(chunk)
+        stats.append(gaussian)
+    return stats[0].frechet_distance(stats[1])
+
+
+def streamed_mmd(chunks, source_keys, counterfactual_keys, sigma = 10, scale = 1000):
+    # exact Gaussian-kernel MMD as in CMMD (Jayasumana et al., 2024), the kernel matrices are summed block by block
+    def kernel_mean(x_keys, y_keys):
+        total = 0.0
+        for x in chunks(x_keys):
+            for y in chunks(y_keys):
+                total += gaussian_kernel(x, y, sigma).sum()
+        return total / (len(x_keys) * len(y_keys))
+    return float(scale * (kernel_mean(source_keys, source_keys) + kernel_mean(counterfactual_keys, counterfactual_keys)
+                          - 2 * kernel_mean(source_keys, counterfactual_keys)))
+
+
+# metric -> (embedding it is computed on, streamed function of the source and counterfactual keys)
+METRICS = {
+    "s3": ("simsiam", streamed_s3),
+    "fid": ("inception", streamed_frechet),
+    "sfid": ("inception_spatial", streamed_frechet),
+    "cmmd": ("clip", streamed_mmd),
+}
+
+
+class MetricsEngine:
+    """
+    Computes S3, FID, sFID and CMMD from cached per-image embeddings.
+
+    Every image is hashed, only the images missing from a store are decoded (once for all the
+    extractors) and embedded, and the metrics are derived from the stored features, read back from
+    the memory-mapped stores chunk_size rows at a time. Re-evaluating after adding a few
+    counterfactuals only embeds the new images.
+
+    Args:
+        extractors (list): SimSiamExtractor / InceptionExtractor / ClipExtractor instances.
+        cache_dir (str): Folder of the embedding stores.
+        chunk_size (int): Rows of a store read at once by the metrics.
+    """
+
+    def __init__(self, extractors, cache_dir, batch_size = 32, num_workers = 4, chunk_size = 4096):
+        self.extractors = extractors
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.stores = {}
+        for extractor in extractors:
+            for name, dim in extractor.dims.items():
+                self.stores[name] = EmbeddingStore(os.path.join(cache_dir, name), dim)
+        self.hashes = {}
+
+    def image_hash(self, path):
+        # memoized per (path, size, mtime), like PredictionCache.image_hash
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        if key not in self.hashes:
+            self.hashes[key] = file_hash(path)
+        return self.hashes[key]
+
+    @torch.inference_mode()
+    def embed(self, paths):
+        """
+        Embeds the images of paths that are missing from the stores.
+
+        Returns:
+            list: Content hashes of paths, the keys of their embeddings in every store.
+        """
+        hashes = [self.image_hash(p) for p in paths]
+        missing = {}
+        for p, h in zip(paths, hashes):
+            if any(h not in store for store in self.stores.values()):
+                missing.setdefault(h, p)
+
+        if missing:
+            keys = list(missing)
+            dataset = MultiTransformDataset([missing[k] for k in keys], [e.transform for e in self.extractors])
+            loader = data.DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
+            start = 0
+            for batches in tqdm(loader, desc="Embedding new images"):
+                batch_keys = keys[start:start + len(batches[0])]
+                start += len(batches[0])
+                for extractor, batch in zip(self.extractors, batches):
+                    for name, features in extractor(batch.float()).items():
+                        self.stores[name].put(batch_keys, features)
+            for store in self.stores.values():
+                store.flush()
+
+        return hashes
+
+    def chunks(self, name, keys):
+        # the stored embeddings of keys, chunk_size rows at a time
+        store = self.stores[name]
+        for start in range(0, len(keys), self.chunk_size):
+            yield store.get(keys[start:start + self.chunk_size])
+
+    def streaming_metrics(self, n_features = 4096, sigma = 10, seed = 0):
+        # empty StreamingMetrics for the embeddings of this engine: Frechet statistics for FID/sFID,
+        # random Fourier features for CMMD
+        return StreamingMetrics(dims={name: self.stores[name].dim for name, fn in METRICS.values()
+                                      if fn is streamed_frechet and name in self.stores},
+                                mmd_dims={name: self.stores[name].dim for name, fn in METRICS.values()
+                                          if fn is streamed_mmd and name in self.stores},
+                                n_features=n_features, sigma=sigma, seed=seed)
+
+    def accumulate(self, pairs, stats):
+        """
+        Adds pairs to a streaming_stats.StreamingMetrics (see streaming_metrics), chunk by chunk from
+        the stores. Workers can each accumulate a shard of the pairs, save it, and the shards are
+        combined with StreamingMetrics.merge_files; CMMD is then the random-feature approximation.
+
+        Returns:
+            StreamingMetrics: stats.
+        """
+        source_keys = self.embed([s for s, _ in pairs])
+        counterfactual_keys = self.embed([c for _, c in pairs])
+        names = set(stats.gaussian) | set(stats.rff)
+        for start in range(0, len(pairs), self.chunk_size):
+            s_keys = source_keys[start:start + self.chunk_size]
+            c_keys = counterfactual_keys[start:start + self.chunk_size]
+            similarity = None
+            if "simsiam" in self.stores:
+                similarity = cosine_similarity(self.stores["simsiam"].get(s_keys), self.stores["simsiam"].get(c_keys))
+            stats.update(similarity=similarity,
+                         source_features={name: self.stores[name].get(s_keys) for name in names},
+                         counterfactual_features={name: self.stores[name].get(c_keys) for name in names})
+        return stats
+
+    def evaluate(self, pairs, metrics = ("s3", "fid", "sfid", "cmmd")):
+        """
+        Args:
+            pairs (list): (source_path, counterfactual_path) pairs, e.g. from
+                cf_collector.read_manifest or ResultIndex.pairs.
+            metrics (tuple): Metrics to compute, their embeddings must have an extractor.
+
+        Returns:
+            dict: Metric name -> value.
+        """
+        source_keys = self.embed([s for s, _ in pairs])
+        counterfactual_keys = self.embed([c for _, c in pairs])
+        results = {}
+        for metric in metrics:
+            name, fn = METRICS[metric]
+            results[metric] = fn(lambda keys: self.chunks(name, keys), source_keys, counterfactual_keys)
+        return results
@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 import torch
 import itertools
 import numpy as np
@@ -10,11 +11,15 @@ from torch.utils import data
 from torchvision import transforms
 from simsiam_folder.eval_utils.simsiam import get_simsiam_dist  
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from result_index import ResultIndex
+
 gpu_id =   # GPU id to use
 source_dir =  # Path to the directory containing source images
 counterfactual_dir =   # Path to the directory containing counterfactual images
 weights_path =  # Path to the SimSiam model weights
 batch_size =  # Batch size for processing images
+result_dir = None  # Optional: result tree (one folder per run) to read the pairs from instead of source_dir/counterfactual_dir
 
 
 # Set device
@@ -25,7 +30,7 @@ else:
 print(f"Using device: {device}")
 
 class PairedImageDataset(data.Dataset):
-    def __init__(self, source_dir, counterfactual_dir, transform=None):
+    def __init__(self, source_dir, counterfactual_dir, transform=None, pairs=None):
         """
         Initializes the dataset by pairing source and counterfactual images based on their unique base identifiers.
 
@@ -33,10 +38,17 @@ class PairedImageDataset(data.Dataset):
             source_dir (str): Path to the source images directory.
             counterfactual_dir (str): Path to the counterfactual images directory.
             transform (callable, optional): Optional transform to be applied on a sample.
+            pairs (list, optional): (source_path, counterfactual_path) pairs, e.g. from
+                cf_collector.read_manifest; the directories are not scanned in that case.
         """
         self.source_dir = source_dir
         self.counterfactual_dir = counterfactual_dir
         self.transform = transform
+        self.pairs = pairs
+
+        if pairs is not None:
+            print(f"Found {len(pairs)} paired images.")
+            return
 
         # Regular expressions to extract base identifiers
         # For source images: capture everything before '_source.jpg'
@@ -95,6 +107,8 @@ class PairedImageDataset(data.Dataset):
                 print(f"  Unmatched counterfactual: {fname}_cf.jpg")
 
     def __len__(self):
+        if self.pairs is not None:
+            return len(self.pairs)
         return len(self.common_bases)
 
     def __getitem__(self, idx):
@@ -107,12 +121,15 @@ class PairedImageDataset(data.Dataset):
         Returns:
             tuple: (source_image, counterfactual_image)
         """
-        base_name = self.common_bases[idx]
-        source_filename = f"{base_name}_source.jpg"
-        counterfactual_filename = f"{base_name}_cf.jpg"
+        if self.pairs is not None:
+            source_path, counterfactual_path = self.pairs[idx]
+        else:
+            base_name = self.common_bases[idx]
+            source_filename = f"{base_name}_source.jpg"
+            counterfactual_filename = f"{base_name}_cf.jpg"
 
-        source_path = os.path.join(self.source_dir, source_filename)
-        counterfactual_path = os.path.join(self.counterfactual_dir, counterfactual_filename)
+            source_path = os.path.join(self.source_dir, source_filename)
+            counterfactual_path = os.path.join(self.counterfactual_dir, counterfactual_filename)
 
         # Verify that both files exist
         if not os.path.exists(source_path):
@@ -145,6 +162,16 @@ class PairedImageDataset(data.Dataset):
             raise IOError(f"Error loading image {path}: {e}")
 
 
+class TupleTransform:
+    # applies several transforms to one decoded image, e.g. the SimSiam one and those of the metrics_engine extractors
+
+    def __init__(self, transforms_list):
+        self.transforms_list = transforms_list
+
+    def __call__(self, img):
+        return tuple(t(img) for t in self.transforms_list)
+
+
 # Define image transformations
 transform = transforms.Compose([
     transforms.Resize(256),              # Resize the shorter side to 256
@@ -158,7 +185,7 @@ transform = transforms.Compose([
 
 
 @torch.inference_mode()
-def compute_similarity(oracle, source_dir, counterfactual_dir, batch_size, device):
+def compute_similarity(oracle, source_dir, counterfactual_dir, batch_size, device, pairs=None, stats=None, extractors=None):
     """
     Computes the similarity between source and counterfactual images.
 
@@ -168,15 +195,26 @@ def compute_similarity(oracle, source_dir, counterfactual_dir, batch_size, devic
         counterfactual_dir (str): Directory containing counterfactual images.
         batch_size (int): Number of image pairs per batch.
         device (torch.device): Device to run computations on.
+        pairs (list, optional): (source_path, counterfactual_path) pairs used instead of the directories.
+        stats (streaming_stats.StreamingMetrics, optional): Accumulates the similarities batch by batch
+            instead of keeping them all, e.g. to merge the results of several workers.
+        extractors (list, optional): metrics_engine InceptionExtractor / ClipExtractor instances; the
+            loader also yields their views of every image and their features go to stats (FID, sFID
+            and CMMD in the same pass). Requires stats with their embeddings, e.g.
+            StreamingMetrics(dims={"inception": 2048}, mmd_dims={"clip": 768}).
 
     Returns:
-        np.ndarray: Array of similarity scores.
+        np.ndarray: Array of similarity scores, or stats if given.
     """
+    if extractors and stats is None:
+        raise ValueError("The extractor features are only accumulated into stats, pass a StreamingMetrics")
+
     # Initialize the dataset and dataloader
     dataset = PairedImageDataset(
         source_dir=source_dir,
         counterfactual_dir=counterfactual_dir,
-        transform=transform
+        transform=TupleTransform([transform] + [e.transform for e in extractors]) if extractors else transform,
+        pairs=pairs
     )
     loader = data.DataLoader(
         dataset,
@@ -188,11 +226,23 @@ def compute_similarity(oracle, source_dir, counterfactual_dir, batch_size, devic
 
     similarities = []
     for source, counterfactual in tqdm(loader, desc="Computing similarities"):
+        source_features, counterfactual_features = {}, {}
+        if extractors:
+            (source, *source_views), (counterfactual, *counterfactual_views) = source, counterfactual
+            for extractor, source_view, counterfactual_view in zip(extractors, source_views, counterfactual_views):
+                source_features.update(extractor(source_view.float()))
+                counterfactual_features.update(extractor(counterfactual_view.float()))
         source = source.to(device, dtype=torch.float)
         counterfactual = counterfactual.to(device, dtype=torch.float)
         similarity = oracle(source, counterfactual).cpu().numpy()
-        similarities.append(similarity)
-
+        if stats is not None:
+            stats.update(similarity=similarity, source_features=source_features,
+                         counterfactual_features=counterfactual_features)
+        else:
+            similarities.append(similarity)
+
+    if stats is not None:
+        return stats
     return np.concatenate(similarities)
 
 
@@ -207,7 +257,8 @@ similarities = compute_similarity(
     source_dir=source_dir,
     counterfactual_dir=counterfactual_dir,
     batch_size=batch_size,
-    device=device
+    device=device,
+    pairs=ResultIndex.open(result_dir).pairs() if result_dir else None
 )
 
 # Compute and print the average similarity
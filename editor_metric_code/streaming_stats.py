@@ -0,0 +1,223 @@
+import pickle
+import numpy as np
+
+
+# embedding -> name of the metric computed on it, the keys of StreamingMetrics.results and MetricsEngine.evaluate
+METRIC_NAMES = {"simsiam": "s3", "inception": "fid", "inception_spatial": "sfid", "clip": "cmmd"}
+
+
+def frechet_from_stats(mu1, sigma1, mu2, sigma2):
+    from scipy import linalg
+    diff = mu1 - mu2
+    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
+    if not np.isfinite(covmean).all():
+        offset = np.eye(sigma1.shape[0]) * 1e-6
+        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
+    covmean = covmean.real
+    return float(diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2) - 2 * np.trace(covmean))
+
+
+class RunningMean:
+    # mean of a stream of values (e.g. the S3 similarities) without keeping them
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.n += values.size
+        self.total += values.sum()
+
+    def merge(self, other):
+        self.n += other.n
+        self.total += other.total
+        return self
+
+    def value(self):
+        return float(self.total / self.n) if self.n else float("nan")
+
+
+class GaussianStats:
+    """
+    Running mean and covariance of feature batches (batched Welford / Chan et al. update), the
+    statistics FID and sFID are computed from. Memory is O(dim^2) whatever the number of images.
+
+    Args:
+        dim (int): Feature size, e.g. 2048 for the Inception pool features.
+    """
+
+    def __init__(self, dim):
+        self.n = 0
+        self.mean = np.zeros(dim, dtype=np.float64)
+        self.m2 = np.zeros((dim, dim), dtype=np.float64)
+
+    def update(self, features):
+        x = np.asarray(features, dtype=np.float64).reshape(len(features), -1)
+        n_b = x.shape[0]
+        if n_b == 0:
+            return
+        mean_b = x.mean(axis=0)
+        centered = x - mean_b
+        self._combine(n_b, mean_b, centered.T @ centered)
+
+    def _combine(self, n_b, mean_b, m2_b):
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.m2 += m2_b + np.outer(delta, delta) * (self.n * n_b / n)
+        self.mean += delta * (n_b / n)
+        self.n = n
+
+    def merge(self, other):
+        # statistics of the union of the two streams, e.g. shards computed by different workers
+        if other.n:
+            self._combine(other.n, other.mean, other.m2)
+        return self
+
+    def covariance(self):
+        if self.n < 2:
+            raise ValueError(f"The covariance needs at least 2 samples, got {self.n}")
+        return self.m2 / (self.n - 1)
+
+    def frechet_distance(self, other):
+        return frechet_from_stats(self.mean, self.covariance(), other.mean, other.covariance())
+
+
+class RFFMeanEmbedding:
+    """
+    Streaming kernel mean embedding with random Fourier features, phi(x) = sqrt(2/D) cos(Wx + b)
+    with W ~ N(0, 1/sigma^2), so that phi(x).phi(y) approximates the Gaussian kernel used by CMMD.
+    MMD^2 between two streams is the squared distance of their mean embeddings, and only the sum
+    of phi is kept.
+
+    All the shards that are merged or compared must use the same dim, n_features, sigma and seed
+    (the same W and b).
+
+    Args:
+        dim (int): Feature size, e.g. the CLIP projection size.
+        n_features (int): Number of random features D, the approximation error decreases as 1/sqrt(D).
+        sigma (float): Kernel bandwidth, 10 in CMMD.
+    """
+
+    def __init__(self, dim, n_features = 4096, sigma = 10, seed = 0):
+        rng = np.random.default_rng(seed)
+        self.config = (dim, n_features, sigma, seed)
+        self.w = rng.normal(scale=1.0 / sigma, size=(dim, n_features))
+        self.b = rng.uniform(0, 2 * np.pi, size=n_features)
+        self.n = 0
+        self.total = np.zeros(n_features, dtype=np.float64)
+
+    def __getstate__(self):
+        # W and b are regenerated from the seed, so the saved shards stay small
+        state = dict(self.__dict__)
+        del state["w"], state["b"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        dim, n_features, sigma, seed = self.config
+        rng = np.random.default_rng(seed)
+        self.w = rng.normal(scale=1.0 / sigma, size=(dim, n_features))
+        self.b = rng.uniform(0, 2 * np.pi, size=n_features)
+
+    def features(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        return np.sqrt(2.0 / self.w.shape[1]) * np.cos(x @ self.w + self.b)
+
+    def update(self, x):
+        if len(x) == 0:
+            return
+        self.n += len(x)
+        self.total += self.features(x).sum(axis=0)
+
+    def merge(self, other):
+        if other.config != self.config:
+            raise ValueError("RFF embeddings with different dim, n_features, sigma or seed cannot be merged")
+        self.n += other.n
+        self.total += other.total
+        return self
+
+    def mean_embedding(self):
+        return self.total / self.n
+
+    def mmd(self, other, scale = 1000):
+        if other.config != self.config:
+            raise ValueError("RFF embeddings with different dim, n_features, sigma or seed cannot be compared")
+        diff = self.mean_embedding() - other.mean_embedding()
+        return float(scale * diff.dot(diff))
+
+
+class StreamingMetrics:
+    """
+    Bounded-memory S3, FID/sFID and CMMD accumulated over batches of source/counterfactual pairs,
+    e.g. the batches of a PairedImageDataset loader embedded by the metrics_engine extractors.
+
+    Accumulators of different shards can be merged (merge) and saved/loaded, so parallel workers
+    can each evaluate a part of the counterfactuals and the results are combined at the end.
+
+    Args:
+        dims (dict): Embedding name -> size for the Frechet distances, e.g.
+            {"inception": 2048, "inception_spatial": 2023}.
+        mmd_dims (dict): Embedding name -> size for the MMD, e.g. {"clip": 768}.
+    """
+
+    def __init__(self, dims = None, mmd_dims = None, n_features = 4096, sigma = 10, seed = 0):
+        dims = dims or {}
+        mmd_dims = mmd_dims or {}
+        self.s3 = RunningMean()
+        self.gaussian = {name: (GaussianStats(d), GaussianStats(d)) for name, d in dims.items()}
+        self.rff = {name: (RFFMeanEmbedding(d, n_features, sigma, seed), RFFMeanEmbedding(d, n_features, sigma, seed))
+                    for name, d in mmd_dims.items()}
+
+    def update(self, similarity = None, source_features = None, counterfactual_features = None):
+        """
+        Args:
+            similarity (np.ndarray, optional): S3 similarities of the batch.
+            source_features (dict, optional): Embedding name -> (batch, dim) features of the sources.
+            counterfactual_features (dict, optional): Same for the counterfactuals.
+        """
+        if similarity is not None:
+            self.s3.update(similarity)
+        for features, side in [(source_features, 0), (counterfactual_features, 1)]:
+            for name, x in (features or {}).items():
+                if name in self.gaussian:
+                    self.gaussian[name][side].update(x)
+                if name in self.rff:
+                    self.rff[name][side].update(x)
+
+    def merge(self, other):
+        self.s3.merge(other.s3)
+        for name, (source, counterfactual) in self.gaussian.items():
+            source.merge(other.gaussian[name][0])
+            counterfactual.merge(other.gaussian[name][1])
+        for name, (source, counterfactual) in self.rff.items():
+            source.merge(other.rff[name][0])
+            counterfactual.merge(other.rff[name][1])
+        return self
+
+    def results(self):
+        # metric name -> value, named as in MetricsEngine.evaluate (s3, fid, sfid, cmmd)
+        results = {}
+        if self.s3.n:
+            results["s3"] = self.s3.value()
+        for name, (source, counterfactual) in self.gaussian.items():
+            results[METRIC_NAMES.get(name, name)] = source.frechet_distance(counterfactual)
+        for name, (source, counterfactual) in self.rff.items():
+            results[METRIC_NAMES.get(name, name)] = source.mmd(counterfactual)
+        return results
+
+    def save(self, path):
+        with open(path, "wb") as handle:
+            pickle.dump(self, handle)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as handle:
+            return pickle.load(handle)
+
+    @classmethod
+    def merge_files(cls, paths):
+        stats = cls.load(paths[0])
+        for path in paths[1:]:
+            stats.merge(cls.load(path))
+        return stats
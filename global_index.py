@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+
+# bump when the stored format or the way the explanations are computed changes
+INDEX_VERSION = 1
+
+# xDataset used by the worker processes, set once per worker by the pool initializer
+_worker_ds = None
+
+
+def _init_worker(ds):
+    global _worker_ds
+    _worker_ds = ds
+
+
+def _explain_label(regional_dataset, regional_labels):
+    gl = _worker_ds.global_explanation(regional_dataset, regional_labels)
+    return {k: v for k, v in gl.items() if "." not in k}
+
+
+def _canonical(row):
+    # rows are lists of objects, an object is a concept name or a set of concepts
+    return [sorted(obj) if isinstance(obj, (set, frozenset)) else obj for obj in row]
+
+
+def dataset_fingerprint(dataset, labels):
+    # independent of set iteration order, which changes between interpreter runs
+    h = hashlib.sha256()
+    for row, label in zip(dataset, labels):
+        h.update(json.dumps([_canonical(row), label], default=str).encode("utf-8"))
+    h.update(str(len(dataset)).encode("utf-8"))
+    return h.hexdigest()
+
+
+class GlobalExplanationIndex:
+    """
+    Global explanations of an xDataset computed once per label.
+
+    The explanation of an image only depends on its original label, so instead of rebuilding the
+    regional dataset and calling ds.global_explanation for every edited image, all the labels are
+    explained up front (in parallel) and stored on disk together with a fingerprint of the dataset.
+
+    Args:
+        ds (xDataset): Dataset providing global_explanation.
+        dataset (list): Rows passed to global_explanation, as in the notebooks.
+        labels (list): Label of each row.
+        max_rows (int, optional): Only the first max_rows rows are used (the BDD notebook uses 200).
+    """
+
+    def __init__(self, ds, dataset, labels, max_rows = None):
+        self.ds = ds
+        self.dataset = dataset[:max_rows] if max_rows is not None else dataset
+        self.labels = labels[:max_rows] if max_rows is not None else labels
+        self.fingerprint = dataset_fingerprint(self.dataset, self.labels)
+        self.explanations = {}
+
+    def build(self, max_workers = None):
+        regional = {}
+        for l, r in zip(self.labels, self.dataset):
+            regional.setdefault(l, ([], []))
+            regional[l][0].append(r)
+            regional[l][1].append(l)
+
+        if max_workers == 1:
+            _init_worker(self.ds)
+            self.explanations = {l: _explain_label(rows, ls) for l, (rows, ls) in regional.items()}
+            return self
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(self.ds,)) as executor:
+            futures = {l: executor.submit(_explain_label, rows, ls) for l, (rows, ls) in regional.items()}
+            self.explanations = {l: future.result() for l, future in futures.items()}
+        return self
+
+    def save(self, path):
+        with open(path, "wb") as handle:
+            pickle.dump({"version": INDEX_VERSION,
+                         "fingerprint": self.fingerprint,
+                         "explanations": self.explanations}, handle)
+
+    def load(self, path):
+        """
+        Returns:
+            bool: True if the file was written for this dataset and version and has been loaded.
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as handle:
+            stored = pickle.load(handle)
+        if stored.get("version") != INDEX_VERSION or stored.get("fingerprint") != self.fingerprint:
+            return False
+        self.explanations = stored["explanations"]
+        return True
+
+    @classmethod
+    def load_or_build(cls, path, ds, dataset, labels, max_rows = None, max_workers = None):
+        index = cls(ds, dataset, labels, max_rows)
+        if not index.load(path):
+            index.build(max_workers)
+            index.save(path)
+        return index
+
+    def __getitem__(self, label):
+        return self.explanations[label]
+
+    def get(self, label, default = None):
+        return self.explanations.get(label, default)
+
+    def __contains__(self, label):
+        return label in self.explanations
@@ -0,0 +1,151 @@
+import hashlib
+import io
+import os
+import pickle
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+
+class ImageMirror:
+    """
+    Local content-addressed mirror of the source images of a dataset (e.g. the "url" of every entry
+    of data/vg_data_random.pickle).
+
+    prefetch downloads all the URLs once with a pooled session and concurrent workers, checks that
+    every download is a complete, decodable image and stores it under objects/<sha256[:2]>/<sha256>.
+    The edit loops then copy the source image from disk (copy_to) instead of starting every run
+    with a cold HTTP request.
+
+    Args:
+        root (str): Folder of the mirror.
+        source (str, optional): Folder holding the images by file name, used instead of HTTP (for
+            tests and machines with a local copy of the dataset).
+        max_workers (int): Concurrent downloads, also the size of the connection pool.
+        timeout (float): Timeout of a request in seconds.
+    """
+
+    def __init__(self, root, source = None, max_workers = 16, timeout = 30, retries = 3):
+        self.root = root
+        self.source = source
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.manifest_path = os.path.join(root, "manifest.pickle")
+        self.manifest = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "rb") as handle:
+                self.manifest = pickle.load(handle)
+
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def fetch(self, url):
+        if self.source is not None:
+            with open(os.path.join(self.source, os.path.basename(url)), "rb") as f:
+                return f.read()
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        content = response.content
+        expected = response.headers.get("Content-Length")
+        if expected is not None and "Content-Encoding" not in response.headers and int(expected) != len(content):
+            raise IOError(f"Truncated download of {url}: {len(content)} of {expected} bytes")
+        return content
+
+    @staticmethod
+    def check_image(content):
+        # raises if the bytes are not a complete image (truncated download, HTML error page, ...)
+        with Image.open(io.BytesIO(content)) as img:
+            img.verify()
+
+    def is_mirrored(self, url):
+        entry = self.manifest.get(url)
+        return entry is not None and os.path.exists(self.object_path(entry["sha256"]))
+
+    def mirror(self, url):
+        """
+        Returns:
+            str: Local path of the image of url, downloaded if it is not mirrored yet.
+        """
+        if self.is_mirrored(url):
+            return self.object_path(self.manifest[url]["sha256"])
+
+        content = self.fetch(url)
+        self.check_image(content)
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.manifest[url] = {"sha256": digest, "size": len(content)}
+        return path
+
+    def _mirror_or_error(self, url):
+        try:
+            return url, self.mirror(url), None
+        except Exception as e:
+            return url, None, e
+
+    def prefetch(self, urls):
+        """
+        Mirrors all the urls concurrently.
+
+        Returns:
+            dict: url -> exception of the downloads that failed.
+        """
+        todo = [url for url in dict.fromkeys(urls) if not self.is_mirrored(url)]
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for url, _, error in executor.map(self._mirror_or_error, todo):
+                if error is not None:
+                    failed[url] = error
+        self.save()
+        print(f"Mirrored {len(todo) - len(failed)} new images, {len(failed)} failed, {len(self.manifest)} in total")
+        return failed
+
+    def verify(self):
+        """
+        Re-hashes every mirrored image and drops the ones that are missing or corrupted, so the next
+        prefetch downloads them again.
+
+        Returns:
+            list: URLs of the dropped images.
+        """
+        dropped = []
+        for url, entry in list(self.manifest.items()):
+            path = self.object_path(entry["sha256"])
+            ok = os.path.exists(path)
+            if ok:
+                with open(path, "rb") as f:
+                    ok = hashlib.sha256(f.read()).hexdigest() == entry["sha256"]
+            if not ok:
+                dropped.append(url)
+                del self.manifest[url]
+        self.save()
+        return dropped
+
+    def copy_to(self, url, filename):
+        # drop-in replacement of download_image_from_url(url, filename)
+        shutil.copyfile(self.mirror(url), filename)
+
+    def save(self):
+        with self.lock:
+            with open(self.manifest_path + ".tmp", "wb") as handle:
+                pickle.dump(self.manifest, handle)
+            os.replace(self.manifest_path + ".tmp", self.manifest_path)
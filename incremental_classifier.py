@@ -0,0 +1,295 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from PIL import Image
+
+
+def receptive_radius(module):
+    """
+    Upper bound of the receptive-field radius (in input pixels) of the conv/pool layers of module,
+    walking them as if they were applied one after the other. Parallel branches (e.g. a ResNet
+    downsample) are counted as extra layers, which only makes the bound larger.
+    """
+    radius, jump = 0, 1
+    for m in module.modules():
+        if isinstance(m, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+            k = m.kernel_size if isinstance(m.kernel_size, int) else max(m.kernel_size)
+            s = m.stride if isinstance(m.stride, int) else max(m.stride)
+            d = getattr(m, "dilation", 1)
+            d = d if isinstance(d, int) else max(d)
+            radius += ((k - 1) * d * jump + 1) // 2
+            jump *= s
+    return radius
+
+
+def split_resnet(model, until = "layer1"):
+    """
+    Splits a torchvision ResNet into stem (conv1 ... until) and head (the remaining layers, pooling
+    and fc), so that head(stem(x)) == model(x).
+    """
+    names = ["conv1", "bn1", "relu", "maxpool", "layer1", "layer2", "layer3", "layer4"]
+    cut = names.index(until) + 1
+    stem = nn.Sequential(*[getattr(model, n) for n in names[:cut]])
+    head = nn.Sequential(*[getattr(model, n) for n in names[cut:]], model.avgpool, nn.Flatten(1), model.fc)
+    return stem, head
+
+
+class _DenseNetHead(nn.Module):
+
+    def __init__(self, features, classifier):
+        super().__init__()
+        self.features = features
+        self.classifier = classifier
+
+    def forward(self, x):
+        # the end of torchvision's DenseNet.forward
+        out = F.relu(self.features(x), inplace=True)
+        out = F.adaptive_avg_pool2d(out, (1, 1))
+        return self.classifier(torch.flatten(out, 1))
+
+
+def split_densenet(model, until = "denseblock1"):
+    """
+    Splits a torchvision-style DenseNet (model.features + model.classifier) after the features
+    module named until.
+    """
+    children = list(model.features.named_children())
+    cut = [n for n, _ in children].index(until) + 1
+    stem = nn.Sequential(*[m for _, m in children[:cut]])
+    head = _DenseNetHead(nn.Sequential(*[m for _, m in children[cut:]]), model.classifier)
+    return stem, head
+
+
+class _Normalize(nn.Module):
+    # the (x - mean) / std of a normalizing wrapper, kept at the start of the stem
+
+    def __init__(self, mean, std):
+        super().__init__()
+        self.register_buffer("mean", torch.as_tensor(mean, dtype=torch.float).reshape(1, -1, 1, 1))
+        self.register_buffer("std", torch.as_tensor(std, dtype=torch.float).reshape(1, -1, 1, 1))
+
+    def forward(self, x):
+        return (x - self.mean) / self.std
+
+
+class _Select(nn.Module):
+    # the x[:, query_label] at the end of DecisionDensenetModel.forward
+
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def forward(self, x):
+        return x[:, self.index]
+
+
+def _normalization(model):
+    # (mean, std) of a wrapper like TIME's Normalizer, None for other modules
+    for mean_name, std_name in [("mu", "sigma"), ("mean", "std")]:
+        mean, std = getattr(model, mean_name, None), getattr(model, std_name, None)
+        if mean is not None and std is not None and not isinstance(mean, nn.Module):
+            return mean, std
+    return None
+
+
+def split_model(model, until = None):
+    """
+    Splits a classifier into stem and head for IncrementalClassifier. Besides torchvision ResNets and
+    DenseNets this unwraps the BDD100k classifier of TIME's get_classifier,
+    Normalizer(DecisionDensenetModel(DenseNet121(densenet121))): the normalization goes at the start
+    of the stem and the linear layer and the query_label column at the end of the head.
+    """
+    if hasattr(model, "layer1") and hasattr(model, "fc"):
+        return split_resnet(model, until or "layer1")
+    if hasattr(model, "features") and hasattr(model, "classifier"):
+        return split_densenet(model, until or "denseblock1")
+    normalization = _normalization(model)
+    if normalization is not None and isinstance(getattr(model, "classifier", None), nn.Module):
+        stem, head = split_model(model.classifier, until)
+        return nn.Sequential(_Normalize(*normalization), stem), head
+    if hasattr(model, "feat_extract") and hasattr(model, "classifier"):
+        stem, head = split_model(model.feat_extract, until)
+        if hasattr(model, "query_label"):
+            return stem, nn.Sequential(head, model.classifier, _Select(model.query_label))
+        return stem, nn.Sequential(head, model.classifier)
+    if hasattr(model, "feat_extract"):
+        # DenseNet121, whose forward is feat_extract(x)
+        return split_model(model.feat_extract, until)
+    raise ValueError(f"No split for {type(model).__name__}, pass stem and head explicitly")
+
+
+@torch.inference_mode()
+def verify_split(model, stem, head, x, atol = 1e-4):
+    """
+    Checks that head(stem(x)) gives the outputs of model(x), e.g. on an image of the dataset with the
+    real checkpoint, before trusting a split.
+
+    Returns:
+        float: Largest absolute difference of the outputs.
+    """
+    expected = model(x).float()
+    split = head(stem(x)).float()
+    if expected.shape != split.shape:
+        raise ValueError(f"The split outputs have shape {tuple(split.shape)}, the model {tuple(expected.shape)}")
+    error = float((expected - split).abs().max())
+    if error > atol:
+        raise ValueError(f"The split differs from the model by {error} (atol {atol})")
+    return error
+
+
+class IncrementalClassifier:
+    """
+    Re-scores the images of an edit chain by recomputing only the part of the early layers that an
+    edit can affect.
+
+    The decoded input tensor and the stem feature map of the previous step are kept. For a new step
+    the changed region is taken from the inpainting mask (or from the pixel difference with the
+    previous step), grown by the receptive field of the stem and aligned to its stride; the stem is
+    run on that crop only, the exact part of its output is pasted into the cached feature map and
+    the head runs on the patched map. Large changes fall back to full inference.
+
+    Without a mask the result is that of the full model up to `tolerance`. With a mask, pixels
+    outside the (grown) mask are taken as unchanged, so differences there (JPEG re-encoding, VAE
+    round trip) are ignored and accumulate in the cached feature map over a chain of steps; the
+    result is then only an approximation of the full model. Every full_every-th step is therefore
+    recomputed in full, which resets that drift.
+
+    Args:
+        stem (nn.Module): Early convolutional layers, see split_model.
+        head (nn.Module): Rest of the network, head(stem(x)) are the logits.
+        transform (callable): PIL image -> input tensor, the classifier's transform.
+        mask_transform (callable): PIL mask -> (1, H, W) tensor aligned with the input tensor.
+        postprocess (callable): Logits -> the classifier's output (e.g. the label).
+        max_fraction (float): Largest fraction of the image recomputed incrementally.
+        mask_margin (int): Pixels added around the mask (inpainting blends beyond its border).
+        full_every (int): Consecutive incremental steps after which the next step is recomputed in
+            full (0 never does).
+    """
+
+    def __init__(self, stem, head, transform, mask_transform, postprocess = None, device = "cpu",
+                 max_fraction = 0.35, mask_margin = 8, tolerance = 0.0, full_every = 4):
+        self.stem = stem.to(device).eval()
+        self.head = head.to(device).eval()
+        self.transform = transform
+        self.mask_transform = mask_transform
+        self.postprocess = postprocess or (lambda logits: logits)
+        self.device = device
+        self.max_fraction = max_fraction
+        self.mask_margin = mask_margin
+        self.tolerance = tolerance
+        self.full_every = full_every
+        self.radius = receptive_radius(stem)
+        self.stride = None
+        self.reset()
+
+    def reset(self):
+        # forget the previous step, e.g. when the edit chain of a new image starts
+        self.x = None
+        self.features = None
+        self.logits = None
+        self.since_full = 0
+        self.stats = {"full": 0, "incremental": 0, "unchanged": 0, "recomputed_fraction": 0.0}
+
+    def load(self, image):
+        if isinstance(image, str):
+            with open(image, "rb") as f:
+                image = Image.open(f).convert("RGB")
+        return self.transform(image).unsqueeze(0).to(self.device)
+
+    def _full(self, x):
+        self.features = self.stem(x)
+        self.stride = x.shape[2] // self.features.shape[2]
+        self.since_full = 0
+        self.stats["full"] += 1
+        return self.head(self.features)
+
+    def changed_box(self, x, mask):
+        if mask is not None:
+            changed = self.mask_transform(mask)[0] > 0.5
+            if self.mask_margin:
+                changed = F.max_pool2d(changed[None, None].float(), 2 * self.mask_margin + 1, 1, self.mask_margin)[0, 0] > 0
+        else:
+            changed = (x - self.x).abs().amax(dim=1)[0] > self.tolerance
+        rows = torch.nonzero(changed.any(dim=1)).flatten()
+        cols = torch.nonzero(changed.any(dim=0)).flatten()
+        if len(rows) == 0:
+            return None
+        return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+    def _span(self, start, end, size):
+        # crop [lo, hi) of the input, aligned to the stride, and the rows/cols [a, b) of the crop
+        # output that are exact (not influenced by the zero padding at the crop border)
+        s = self.stride
+        halo = self.radius + s
+        lo = max(0, (start - 2 * halo - s) // s * s)
+        hi = min(size, math.ceil((end + 2 * halo + s) / s) * s)
+        margin = math.ceil(halo / s)
+        a = 0 if lo == 0 else margin
+        b_margin = 0 if hi == size else margin
+        return lo, hi, a, b_margin
+
+    @torch.inference_mode()
+    def score(self, image, mask = None):
+        """
+        Args:
+            image (str or PIL.Image): The image of the current step.
+            mask (PIL.Image, optional): Inpainting mask of the edit that produced it (white = edited),
+                as returned by Editor.replacer.
+
+        Returns:
+            The postprocessed logits of the image.
+        """
+        x = self.load(image)
+        if self.x is None or x.shape != self.x.shape or (self.full_every and self.since_full >= self.full_every):
+            self.logits = self._full(x)
+            self.x = x
+            return self.postprocess(self.logits)
+
+        box = self.changed_box(x, mask)
+        if box is None:
+            self.x = x
+            self.stats["unchanged"] += 1
+            return self.postprocess(self.logits)
+
+        H, W = x.shape[2], x.shape[3]
+        y0, y1, ya, yb = self._span(box[0], box[1], H)
+        x0, x1, xa, xb = self._span(box[2], box[3], W)
+        fraction = (y1 - y0) * (x1 - x0) / (H * W)
+        if fraction > self.max_fraction:
+            self.logits = self._full(x)
+            self.x = x
+            return self.postprocess(self.logits)
+
+        patch = self.stem(x[:, :, y0:y1, x0:x1])
+        s = self.stride
+        rows = patch.shape[2] - yb
+        cols = patch.shape[3] - xb
+        self.features[:, :, y0 // s + ya:y0 // s + rows, x0 // s + xa:x0 // s + cols] = patch[:, :, ya:rows, xa:cols]
+        self.logits = self.head(self.features)
+        self.x = x
+        self.since_full += 1
+        self.stats["incremental"] += 1
+        self.stats["recomputed_fraction"] += fraction
+        return self.postprocess(self.logits)
+
+
+class IncrementalMargin:
+    """
+    cheap_margin of MarginScheduler backed by an IncrementalClassifier: the steps whose inpainting
+    mask is passed to MarginScheduler.classify are re-scored from the edited region only, the others
+    in full (see IncrementalClassifier for what the mask assumes).
+
+    Args:
+        scorer (IncrementalClassifier): Returns the raw logits (no postprocess).
+        margin_from_logits (callable): margin_from_logits(logits, reference) -> (label, margin), the
+            classifier's margin on logits.
+    """
+
+    def __init__(self, scorer, margin_from_logits):
+        self.scorer = scorer
+        self.margin_from_logits = margin_from_logits
+
+    def __call__(self, image_path, reference = None, mask = None):
+        return self.margin_from_logits(self.scorer.score(image_path, mask), reference)
@@ -0,0 +1,131 @@
+import os
+import pickle
+
+
+class MarginScheduler:
+    """
+    Schedules the classifications of an edit loop from the margin of a cheap classifier.
+
+    After every edit the cheap classifier (the CNN) measures how far the image still is from its
+    decision boundary. While that margin stays above threshold the label is taken as unchanged and
+    the expensive classification (e.g. the 7-vote LVLM majority) is skipped; once the edits bring the
+    image close to the boundary every step is classified by the expensive classifier.
+
+    The margin drop caused by each edit is also recorded, and rerank orders the remaining edits by
+    their mean observed drop, so edits that moved images towards a flip are tried first. The
+    statistics are kept over all the images the scheduler is used for and can be saved.
+
+    Args:
+        classify (callable): Expensive classify(image_path) -> label.
+        cheap_margin (callable): cheap_margin(image_path, reference) -> (label, margin), e.g. the
+            margin method of BDD100k_classifier or of the places365 Classifier. With the
+            incremental_margin of those classifiers, classify passes the inpainting mask of the step
+            as a third argument and only the edited region is re-scored.
+        threshold (float): Cheap margin above which the expensive classification is skipped.
+        audit_every (int): Run the expensive classification anyway on every audit_every-th skipped step
+            (0 never does). A flip found that way raises the threshold to growth times that margin.
+    """
+
+    def __init__(self, classify, cheap_margin, threshold, audit_every = 0, growth = 1.5):
+        self.classify_fn = classify
+        self.cheap_margin = cheap_margin
+        self.threshold = threshold
+        self.audit_every = audit_every
+        self.growth = growth
+        # edit -> [number of observations, sum of the margin drops]
+        self.deltas = {}
+        self.stats = {"expensive": 0, "skipped": 0, "audited": 0, "missed_flips": 0}
+        self.orig_label = None
+        self.cheap_label = None
+        self.last_margin = None
+
+    def start(self, image_path, label, last_image = None):
+        """
+        Starts the edit chain of a new image.
+
+        Args:
+            image_path (str): The source image.
+            label: Its expensive classification.
+            last_image (str, optional): Last saved step of a resumed chain, the next margin drop is
+                measured from it (and an incremental cheap_margin continues from it).
+
+        Returns:
+            float: The cheap margin of the source image.
+        """
+        self.orig_label = label
+        self.cheap_label, self.last_margin = self.cheap_margin(image_path, None)
+        margin = self.last_margin
+        if last_image is not None and last_image != image_path:
+            _, self.last_margin = self.cheap_margin(last_image, self.cheap_label)
+        return margin
+
+    def classify(self, image_path, edit = None, mask = None):
+        """
+        Drop-in replacement of classify for the steps of the chain.
+
+        Args:
+            image_path (str): The edited image.
+            edit (optional): Hashable id of the edit that produced it (e.g. the object), its margin
+                drop is recorded for rerank.
+            mask (PIL.Image, optional): Inpainting mask of the edit, for an incremental cheap_margin.
+
+        Returns:
+            The expensive label, or the original label when the step was skipped.
+        """
+        if mask is None:
+            _, margin = self.cheap_margin(image_path, self.cheap_label)
+        else:
+            _, margin = self.cheap_margin(image_path, self.cheap_label, mask)
+        if edit is not None:
+            self.record(edit, self.last_margin - margin)
+        self.last_margin = margin
+
+        audit = False
+        if margin > self.threshold:
+            self.stats["skipped"] += 1
+            audit = self.audit_every > 0 and self.stats["skipped"] % self.audit_every == 0
+            if not audit:
+                return self.orig_label
+            self.stats["audited"] += 1
+
+        label = self.classify_fn(image_path)
+        self.stats["expensive"] += 1
+        if audit and label != self.orig_label:
+            # the cheap margin was too optimistic for this kind of image
+            self.stats["missed_flips"] += 1
+            self.threshold = max(self.threshold, margin * self.growth)
+        return label
+
+    def record(self, edit, delta):
+        n, total = self.deltas.get(edit, (0, 0.0))
+        self.deltas[edit] = (n + 1, total + delta)
+
+    def score(self, edit):
+        # mean margin drop of the edit, 0 for edits never observed
+        n, total = self.deltas.get(edit, (0, 0.0))
+        return total / n if n else 0.0
+
+    def rerank(self, items, key = lambda item: item[0]):
+        """
+        Yields the items (e.g. the (obj, v) pairs of the global explanation) largest mean margin drop
+        first. The order is recomputed before every item, so the drops observed on the current image
+        count for its next steps; ties keep the given order.
+        """
+        remaining = list(items)
+        while remaining:
+            best = max(range(len(remaining)), key=lambda i: self.score(key(remaining[i])))
+            yield remaining.pop(best)
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as handle:
+            pickle.dump({"deltas": self.deltas, "threshold": self.threshold}, handle)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as handle:
+            stored = pickle.load(handle)
+        self.deltas = stored["deltas"]
+        self.threshold = max(self.threshold, stored["threshold"])
+        return True
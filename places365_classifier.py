@@ -1,9 +1,9 @@
 import torch
-from torch.autograd import Variable as V
 import torchvision.models as models
 from torchvision import transforms as trn
 from torch.nn import functional as F
 import os
+import numpy as np
 from PIL import Image
 
 from skimage import io
@@ -11,9 +11,16 @@ from skimage import io
 
 class Classifier:
 
-    def __init__(self, arch):
+    def __init__(self, arch, num_threads = None, cache = None, device = "cpu"):
         # th architecture to use
         self.arch = arch
+        self.device = device
+        # optional prediction_cache.PredictionCache shared with the other classifiers
+        self.cache = cache
+
+        # intra-op threads used by the forward pass, None keeps the torch default
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
 
         # load the pre-trained weights
         self.model_file = '%s_places365.pth.tar' % self.arch
@@ -25,7 +32,7 @@ class Classifier:
         checkpoint = torch.load(self.model_file, map_location=lambda storage, loc: storage)
         state_dict = {str.replace(k,'module.',''): v for k,v in checkpoint['state_dict'].items()}
         self.model.load_state_dict(state_dict)
-        self.model.eval()
+        self.model.to(device).eval()
 
 
         # load the image transformer
@@ -49,18 +56,113 @@ class Classifier:
         self.classes = tuple(self.classes)
 
 
+    def load_image(self, img_url):
+        # local files are decoded with PIL directly, URLs go through skimage
+        if os.path.exists(img_url):
+            with Image.open(img_url) as img:
+                return img.convert('RGB')
+        img = io.imread(img_url)
+        return Image.fromarray(img).convert('RGB')
+
     # load the test image
     def classify(self, img_url, top_k = 5):
-      img = io.imread(img_url)
-      img = Image.fromarray(img)
-      input_img = V(self.centre_crop(img).unsqueeze(0))
-
-      # forward pass
-      logit = self.model.forward(input_img)
-      h_x = F.softmax(logit, 1).data.squeeze()
-      probs, idx = h_x.sort(0, True)
+      if self.cache is not None and os.path.exists(img_url):
+          return self.cache.cached(lambda path: self._classify(path, top_k), img_url, f"places365:{self.arch}:top{top_k}")
+      return self._classify(img_url, top_k)
+
+    def _classify(self, img_url, top_k = 5):
+      idx, probs = self.classify_many([img_url], top_k)
       # output the prediction
-      preds = []
-      for i in range(0, top_k):
-          preds.append([self.classes[idx[i]], float(probs[i])])
-      return preds
\ No newline at end of file
+      return self.labels(idx, probs)[0]
+
+    @torch.inference_mode()
+    def classify_many(self, img_urls, top_k = 5, batch_size = 32):
+        """
+        Classifies a list of images with one forward pass per batch.
+
+        Args:
+            img_urls (list): Paths or URLs of the images.
+            top_k (int): Number of top classes kept per image.
+            batch_size (int): Number of images stacked in each forward pass.
+
+        Returns:
+            tuple: (idx, probs) arrays of shape (N, top_k), idx are positions in self.classes.
+        """
+        all_idx, all_probs = [], []
+        for start in range(0, len(img_urls), batch_size):
+            batch = torch.stack([self.centre_crop(self.load_image(url)) for url in img_urls[start:start + batch_size]])
+
+            # forward pass
+            logit = self.model.forward(batch.to(self.device))
+            probs, idx = torch.topk(F.softmax(logit, 1), top_k, dim=1)
+            all_idx.append(idx.cpu().numpy())
+            all_probs.append(probs.cpu().numpy())
+
+        if not all_idx:
+            return np.zeros((0, top_k), dtype=np.int64), np.zeros((0, top_k), dtype=np.float32)
+        return np.concatenate(all_idx), np.concatenate(all_probs)
+
+    @torch.inference_mode()
+    def margin(self, img_url, reference = None):
+        """
+        Classification and distance to the decision boundary of one class.
+
+        Args:
+            img_url (str): Path or URL of the image.
+            reference (str, optional): Class the margin is measured for, defaults to the top class.
+
+        Returns:
+            tuple: (label, margin), label the top class name (classify(img_url)[0][0]) and margin the
+                probability of reference minus the largest probability of the other classes,
+                positive while reference is the top class. The label is a valid reference, as
+                MarginScheduler passes it back.
+        """
+        return self.margin_from_logits(self.model.forward(self.centre_crop(self.load_image(img_url)).unsqueeze(0).to(self.device)), reference)
+
+    def margin_from_logits(self, logit, reference = None):
+        # margin on the output of the model for one image
+        probs = F.softmax(logit, 1)[0].cpu()
+        top = int(probs.argmax())
+        ref = top if reference is None else self.classes.index(reference)
+        others = probs.clone()
+        others[ref] = 0
+        return self.classes[top], float(probs[ref] - others.max())
+
+    def incremental(self, top_k = 5, max_fraction = 0.35, until = None, full_every = 4, check_image = None, postprocess = None):
+        """
+        Incremental scorer for the steps of an edit chain, see incremental_classifier.IncrementalClassifier.
+        score(step_path) returns the [[class_name, prob], ...] list of classify; score(step_path, mask)
+        approximates it, taking the pixels outside the mask as those of the previous step, and every
+        full_every-th step is recomputed in full.
+
+        Args:
+            check_image (str, optional): Image on which the split of the model is checked against the
+                full forward pass (ValueError if they differ).
+            postprocess (callable, optional): Replaces the labels, e.g. to get the logits.
+        """
+        from incremental_classifier import IncrementalClassifier, split_model, verify_split
+        stem, head = split_model(self.model, until)
+        if check_image is not None:
+            verify_split(self.model, stem, head, self.centre_crop(self.load_image(check_image)).unsqueeze(0).to(self.device))
+        mask_transform = trn.Compose([trn.Resize((256,256)), trn.CenterCrop(224), trn.ToTensor()])
+
+        def labels(logit):
+            probs, idx = torch.topk(F.softmax(logit, 1), top_k, dim=1)
+            return self.labels(idx.cpu().numpy(), probs.cpu().numpy())[0]
+
+        return IncrementalClassifier(stem, head, self.centre_crop, mask_transform, postprocess=postprocess or labels,
+                                     device=self.device, max_fraction=max_fraction, full_every=full_every)
+
+    def incremental_margin(self, **kwargs):
+        """
+        Same as margin for MarginScheduler, but the steps classified with their inpainting mask are
+        re-scored incrementally. kwargs go to incremental.
+        """
+        from incremental_classifier import IncrementalMargin
+        return IncrementalMargin(self.incremental(postprocess=lambda logit: logit, **kwargs), self.margin_from_logits)
+
+    def labels(self, idx, probs):
+        # resolve the (N, k) output of classify_many to [[class_name, prob], ...] lists
+        return [[[self.classes[i], float(p)] for i, p in zip(row_idx, row_probs)]
+                for row_idx, row_probs in zip(idx.tolist(), probs.tolist())]
+
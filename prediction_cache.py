@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def file_hash(path, chunk_size = 1 << 20):
+    # sha256 of the image bytes, so identical images share predictions whatever their path
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """
+    Persistent prediction cache stored in a SQLite file.
+
+    Entries are keyed by image content hash + classifier identity + prompt hash + image payload
+    settings and the least recently used entries are evicted once max_entries is exceeded.
+
+    Args:
+        path (str): Path of the SQLite file, created if it does not exist.
+        max_entries (int): Maximum number of predictions kept on disk.
+    """
+
+    def __init__(self, path = "prediction_cache.sqlite", max_entries = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # the cache is shared by threads issuing concurrent LVLM calls
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                key TEXT PRIMARY KEY,
+                                value TEXT NOT NULL,
+                                last_access REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS predictions_lru ON predictions (last_access)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+        # hashing the same file again is avoided while its size and mtime are unchanged
+        self.hashes = {}
+
+    def image_hash(self, image_path):
+        stat = os.stat(image_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self.hashes.get(image_path)
+        if cached is None or cached[0] != signature:
+            cached = (signature, file_hash(image_path))
+            self.hashes[image_path] = cached
+        return cached[1]
+
+    def key(self, image_path, classifier_id, prompt = "", encoder = None):
+        # encoder (image_payload.ImageEncoder): a downsized payload gets its own entries, None is the raw image
+        payload = encoder.settings() if encoder is not None else "raw"
+        return f"{self.image_hash(image_path)}:{classifier_id}:{text_hash(prompt)}:{payload}"
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (found, value), value is None when the key is not cached.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM predictions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self.conn.execute("UPDATE predictions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return True, json.loads(row[0])
+
+    def put(self, key, value):
+        with self.lock:
+            exists = self.conn.execute("SELECT 1 FROM predictions WHERE key = ?", (key,)).fetchone() is not None
+            self.conn.execute("INSERT OR REPLACE INTO predictions (key, value, last_access) VALUES (?, ?, ?)",
+                              (key, json.dumps(value), time.time()))
+            if not exists:
+                self.size += 1
+            if self.size > self.max_entries:
+                self.conn.execute("""DELETE FROM predictions WHERE key IN (
+                                        SELECT key FROM predictions ORDER BY last_access ASC LIMIT ?)""",
+                                  (self.size - self.max_entries,))
+                self.size = self.max_entries
+            self.conn.commit()
+
+    def cached(self, fn, image_path, classifier_id, prompt = "", encoder = None):
+        # returns the cached prediction of fn(image_path) or computes and stores it
+        key = self.key(image_path, classifier_id, prompt, encoder)
+        found, value = self.get(key)
+        if found:
+            return value
+        value = fn(image_path)
+        self.put(key, value)
+        return value
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.size,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,293 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import zipfile
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from editor import NEGATIVE_PROMPT, _gather
+
+
+# Record/replay of the Bedrock and webui calls of the edit loops. Record once against the live
+# services, then rerun the same experiment offline from the archive:
+#
+#   archive = ReplayArchive("replays/bdd100k_global.zip", mode="auto")
+#   bedrock_runtime_client = ReplayBedrockClient(bedrock_runtime_client, archive)   # under Chat.generate
+#   editor = ReplayEditor(Editor(gradio_link), archive)                            # under Editor.replacer
+#
+# With mode="replay" no live client is needed (ReplayBedrockClient(None, archive), ReplayEditor(None, archive))
+# and a request that was not recorded raises ReplayMiss. `python replay.py archive.zip [port]` serves the
+# recorded inpaintings as a stub A1111 replacer endpoint, for code that talks to the webui over HTTP.
+
+
+MODES = ("record", "replay", "auto")
+
+
+class ReplayMiss(KeyError):
+    pass
+
+
+def fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def image_fingerprint(image):
+    # hash of the decoded pixels, the same whether the image comes from a file or from a base64 request
+    image = image.convert("RGB")
+    return hashlib.sha256(repr((image.size, image.mode)).encode("utf-8") + image.tobytes()).hexdigest()
+
+
+def _png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _open_png(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+class ReplayArchive:
+    """
+    Zip archive of recorded responses, keyed by request fingerprint.
+
+    Every response is stored under <namespace>/<fingerprint>/<n>/<file>, n counting the identical
+    requests (e.g. the 7 votes of a majority vote get 7 different answers). When replaying, the n-th
+    identical request gets the n-th recorded response, so a rerun sees exactly the recorded answers.
+
+    Args:
+        path (str): The .zip file, created on the first recording.
+        mode (str): "record" always calls the live service and appends the response, "replay" only
+            serves recorded responses (ReplayMiss otherwise), "auto" replays what was recorded and
+            records the rest.
+        cycle (bool): Once the recorded responses of a request are used up, start again from the
+            first one instead of missing (for the stub server, which outlives the runs).
+    """
+
+    def __init__(self, path, mode = "auto", cycle = False):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.cycle = cycle
+        self.lock = threading.Lock()
+        self.reader = None
+        # (namespace, fingerprint) -> number of recorded responses / of requests served
+        self.recorded = defaultdict(int)
+        self.served = defaultdict(int)
+        self.stats = {"replayed": 0, "recorded": 0}
+        try:
+            with zipfile.ZipFile(path) as archive:
+                names = archive.namelist()
+        except FileNotFoundError:
+            names = []
+            if mode != "replay":
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        for name in names:
+            namespace, fp, n, _ = name.split("/", 3)
+            key = (namespace, fp)
+            self.recorded[key] = max(self.recorded[key], int(n) + 1)
+
+    def _read(self, prefix, files):
+        if self.reader is None:
+            self.reader = zipfile.ZipFile(self.path)
+        return {name: self.reader.read(prefix + name) for name in files}
+
+    def _write(self, prefix, files):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        with zipfile.ZipFile(self.path, "a", compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, data in files.items():
+                # PNGs are already compressed
+                compress = zipfile.ZIP_STORED if name.endswith(".png") else zipfile.ZIP_DEFLATED
+                archive.writestr(prefix + name, data, compress_type=compress)
+
+    def get(self, namespace, fp, files, call = None):
+        """
+        Args:
+            namespace (str): "bedrock" or "webui".
+            fp (str): Fingerprint of the request.
+            files (tuple): Names of the files of a response.
+            call (callable, optional): Live request, returns {file name: bytes}.
+
+        Returns:
+            dict: File name -> bytes of the response.
+        """
+        key = (namespace, fp)
+        with self.lock:
+            n = self.served[key]
+            self.served[key] += 1
+            if self.mode != "record" and self.cycle and self.recorded[key]:
+                n %= self.recorded[key]
+            if self.mode != "record" and n < self.recorded[key]:
+                self.stats["replayed"] += 1
+                return self._read(f"{namespace}/{fp}/{n}/", files)
+            if self.mode == "replay" or call is None:
+                raise ReplayMiss(f"No recorded {namespace} response {n} for request {fp}")
+
+        response = call()
+        with self.lock:
+            n = self.recorded[key]
+            self.recorded[key] += 1
+            self._write(f"{namespace}/{fp}/{n}/", response)
+            self.stats["recorded"] += 1
+        return response
+
+    def close(self):
+        with self.lock:
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+
+class _Body:
+    # stands in for the botocore StreamingBody of an invoke_model response
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class ReplayBedrockClient:
+    """
+    bedrock-runtime client recording or replaying invoke_model, for Chat, AsyncChat and the notebooks' chat.
+
+    The fingerprint is the model id and the request body, which holds the whole conversation
+    (prompts and base64 images), so a changed prompt or image is a new request.
+
+    Args:
+        client: The boto3 bedrock-runtime client, None in replay mode.
+        archive (ReplayArchive): Where the responses are kept.
+    """
+
+    def __init__(self, client, archive):
+        self.client = client
+        self.archive = archive
+
+    def invoke_model(self, modelId, body, contentType = "application/json", **kwargs):
+        body_text = body.decode("utf-8") if isinstance(body, bytes) else body
+
+        def call():
+            response = self.client.invoke_model(modelId=modelId, body=body, contentType=contentType, **kwargs)
+            return {"response.json": response["body"].read()}
+
+        response = self.archive.get("bedrock", fingerprint(modelId, body_text), ("response.json",), call)
+        return {"body": _Body(response["response.json"]), "contentType": "application/json"}
+
+    def __getattr__(self, name):
+        # the other client methods go to the live client
+        return getattr(self.client, name)
+
+
+def webui_fingerprint(image, detection_prompt, positive_prompt, negative_prompt = NEGATIVE_PROMPT):
+    return fingerprint(image_fingerprint(image), detection_prompt, positive_prompt, negative_prompt)
+
+
+class ReplayEditor:
+    """
+    Editor recording or replaying replacer, the result image and the mask are kept as PNG.
+
+    The fingerprint is the pixels of the input image and the prompts; the webui settings (steps,
+    hires fix) are those of the recording.
+
+    Args:
+        editor (Editor or EditorPool): The live editor, None in replay mode.
+        archive (ReplayArchive): Where the responses are kept.
+    """
+
+    def __init__(self, editor, archive, concurrency = 4):
+        self.editor = editor
+        self.archive = archive
+        self.concurrency = concurrency
+
+    def replacer(self, image_path, detection_prompt, positive_prompt, negative_prompt = NEGATIVE_PROMPT, extra_include = ["mask"]):
+        with Image.open(image_path) as img:
+            fp = webui_fingerprint(img, detection_prompt, positive_prompt, negative_prompt)
+
+        def call():
+            image, mask = self.editor.replacer(image_path, detection_prompt, positive_prompt, negative_prompt, extra_include)
+            return {"image.png": _png(image), "mask.png": _png(mask)}
+
+        response = self.archive.get("webui", fp, ("image.png", "mask.png"), call)
+        return _open_png(response["image.png"]), _open_png(response["mask.png"])
+
+    def replacer_many(self, requests_args):
+        return _gather([lambda a=a: self.replacer(*a) for a in requests_args], self.concurrency)
+
+    async def replacer_async(self, *args, **kwargs):
+        return await asyncio.to_thread(self.replacer, *args, **kwargs)
+
+    def is_healthy(self, timeout = 10):
+        return True
+
+
+class StubWebuiHandler(BaseHTTPRequestHandler):
+    # answers the A1111 ping and the replacer requests from self.server.archive
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/internal/ping"):
+            self._send(200, {})
+        else:
+            self._send(404, {"detail": "Not Found"})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/replace"):
+            self._send(404, {"detail": "Not Found"})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        image_data = request["input_image"].split(",")[-1]
+        image = Image.open(io.BytesIO(base64.b64decode(image_data)))
+        fp = webui_fingerprint(image, request.get("detection_prompt"), request.get("positive_prompt"),
+                               request.get("negative_prompt", NEGATIVE_PROMPT))
+        try:
+            response = self.server.archive.get("webui", fp, ("image.png", "mask.png"))
+        except ReplayMiss as e:
+            self._send(404, {"detail": str(e)})
+            return
+        self._send(200, {"image": base64.b64encode(response["image.png"]).decode("utf-8"),
+                         "extra_images": [base64.b64encode(response["mask.png"]).decode("utf-8")],
+                         "info": ""})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_stub(archive, host = "127.0.0.1", port = 7860):
+    """
+    Serves the recorded inpaintings like a local A1111 with the replacer extension, so
+    Editor("http://127.0.0.1:7860") replays them without a GPU or a gradio tunnel.
+
+    Returns:
+        ThreadingHTTPServer: Call serve_forever() (or run it in a thread) and shutdown() when done.
+    """
+    server = ThreadingHTTPServer((host, port), StubWebuiHandler)
+    server.archive = archive
+    return server
+
+
+if __name__ == '__main__':
+    # python replay.py <archive.zip> [port]
+    archive = ReplayArchive(sys.argv[1], mode="replay", cycle=True)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 7860
+    print(f"Serving the recorded webui responses of {sys.argv[1]} on http://127.0.0.1:{port}")
+    serve_stub(archive, port=port).serve_forever()
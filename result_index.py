@@ -0,0 +1,166 @@
+import os
+import pickle
+import re
+
+from run_log import RUN_LOG_NAME, label_changed, map_runs, parse_run_dir, scan_run_dirs
+
+
+# bump when the stored records change
+INDEX_VERSION = 1
+
+STEP_PATTERN = re.compile(r'step_(\d+)\.jpg$')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+def _log_mtime(run_path):
+    for name in [RUN_LOG_NAME, "logs.txt"]:
+        try:
+            return os.stat(os.path.join(run_path, name)).st_mtime_ns
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def index_run(run_path):
+    """
+    Returns:
+        dict: Record of a run folder: source and final step paths, the saved steps, original
+            and final classification and whether an exception was logged.
+    """
+    record = {'run': os.path.basename(run_path),
+              'path': run_path,
+              'mtime': (os.stat(run_path).st_mtime_ns, _log_mtime(run_path)),
+              'source_path': None,
+              'sources': [],
+              'final_step_path': None,
+              'steps': [],
+              'original_classification': None,
+              'final_classification': None,
+              'number_of_steps': None,
+              'exception': False}
+
+    with os.scandir(run_path) as entries:
+        for entry in entries:
+            if entry.name.startswith('source') and entry.name.endswith(IMAGE_EXTENSIONS):
+                record['sources'].append(entry.path)
+                if entry.name == "source.jpg":
+                    record['source_path'] = entry.path
+            match = STEP_PATTERN.match(entry.name)
+            if match:
+                record['steps'].append(int(match.group(1)))
+    record['sources'].sort()
+    record['steps'].sort()
+    if record['steps']:
+        record['final_step_path'] = os.path.join(run_path, f"step_{record['steps'][-1]}.jpg")
+
+    log_data = parse_run_dir(run_path)
+    if log_data is not None:
+        record['original_classification'] = log_data['original_classification']
+        record['final_classification'] = log_data['final_classification']
+        record['number_of_steps'] = log_data['number_of_steps']
+        record['exception'] = log_data['exceptions'] > 0
+    return record
+
+
+class ResultIndex:
+    """
+    Incremental index of a result tree (one folder per edited image).
+
+    The tree is scanned once and every run folder is summarised in a record; update() only re-reads
+    the folders whose mtime or log mtime changed, so the parsers, the S3 metric and the Claude
+    predictor can query the tree without crawling it again. With a path the records are also kept
+    on disk between sessions; the result tree itself is never written to.
+
+    Args:
+        base_directory (str): Folder with one subfolder per run.
+        path (str, optional): Index file (pickle), outside base_directory. None keeps the index in
+            memory only.
+    """
+
+    def __init__(self, base_directory, path = None):
+        self.base_directory = base_directory
+        self.path = path
+        self.runs = {}
+        self.load()
+
+    @classmethod
+    def open(cls, base_directory, path = None, max_workers = None):
+        index = cls(base_directory, path)
+        index.update(max_workers)
+        return index
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as handle:
+            stored = pickle.load(handle)
+        if stored.get("version") != INDEX_VERSION:
+            return False
+        self.runs = stored["runs"]
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path + ".tmp", "wb") as handle:
+            pickle.dump({"version": INDEX_VERSION, "runs": self.runs}, handle)
+        os.replace(self.path + ".tmp", self.path)
+
+    def update(self, max_workers = None):
+        """
+        Re-indexes the new and changed run folders (in a process pool) and drops the removed ones.
+
+        Returns:
+            int: Number of re-indexed runs.
+        """
+        changed, seen = [], set()
+        for entry in scan_run_dirs(self.base_directory):
+            seen.add(entry.name)
+            record = self.runs.get(entry.name)
+            if record is None or record['mtime'] != (entry.stat().st_mtime_ns, _log_mtime(entry.path)):
+                changed.append(entry.path)
+
+        removed = set(self.runs) - seen
+        for name in removed:
+            del self.runs[name]
+
+        for run_path, (record, error) in zip(changed, map_runs(index_run, changed, max_workers)):
+            if error is not None:
+                print(f"Error indexing {run_path}: {error}")
+                continue
+            self.runs[record['run']] = record
+
+        if changed or removed:
+            self.save()
+        return len(changed)
+
+    def records(self, skip_exceptions = False):
+        records = [self.runs[name] for name in sorted(self.runs)]
+        if skip_exceptions:
+            records = [r for r in records if not r['exception']]
+        return records
+
+    def source_paths(self):
+        # every source* image of the run folders, as claude_predictor.source_images always listed them
+        return [path for r in self.records() for path in r['sources']]
+
+    def final_step(self, run):
+        # path of the largest step_i.jpg, the image that changed the class if the run succeeded
+        record = self.runs.get(run)
+        return record['final_step_path'] if record is not None else None
+
+    def counterfactuals(self, changed_fn = label_changed, skip_exceptions = False):
+        # runs whose final classification differs from the original one
+        return [r for r in self.records(skip_exceptions)
+                if r['original_classification'] is not None and r['final_classification'] is not None
+                and changed_fn(r['original_classification'], r['final_classification'])]
+
+    def pairs(self, changed_fn = label_changed, skip_exceptions = False):
+        """
+        Returns:
+            list: (source_path, counterfactual_path) of the counterfactual runs, e.g. for
+                PairedImageDataset(pairs=...).
+        """
+        return [(r['source_path'], os.path.join(r['path'], f"step_{r['number_of_steps']}.jpg"))
+                for r in self.counterfactuals(changed_fn, skip_exceptions)
+                if r['source_path'] is not None and r['number_of_steps'] in r['steps']]
@@ -0,0 +1,274 @@
+import ast
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+
+RUN_LOG_NAME = "run_log.jsonl"
+
+
+def _jsonable(o):
+    # tensors and numpy values (labels, probabilities) are stored as plain lists/numbers
+    if hasattr(o, "tolist"):
+        return o.tolist()
+    return str(o)
+
+
+class RunLogger:
+    """
+    Structured log of an edit run, one JSON record per line in run_dir/run_log.jsonl.
+
+    Records have a "type": "start" (original classification), "step" (edit, LVLM prompt and
+    output, classification and the time spent in each stage), "exception" and "end" (all the
+    steps). Every record is flushed as it is written, so the log of an interrupted run is
+    readable up to its last step.
+
+    Args:
+        run_dir (str): Folder of the run (the one holding source.jpg and the step_i.jpg images).
+    """
+
+    def __init__(self, run_dir):
+        self.path = os.path.join(run_dir, RUN_LOG_NAME)
+        self.handle = open(self.path, "a")
+        self.timings = {}
+        self.lvlm_calls = []
+        self.t0 = time.time()
+
+    def write(self, record):
+        record["time"] = round(time.time() - self.t0, 4)
+        self.handle.write(json.dumps(record, default=_jsonable) + "\n")
+        self.handle.flush()
+
+    @contextmanager
+    def timer(self, stage):
+        # seconds per stage ("lvlm", "inpaint", "classify") are added to the next step record
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    def start(self, label, image = None, probabilities = None):
+        self.write({"type": "start", "label": label, "probabilities": probabilities,
+                    "image": image, "timings": self.timings})
+        self.timings = {}
+
+    def lvlm(self, prompt, output):
+        self.lvlm_calls.append({"prompt": prompt, "output": output})
+
+    def step(self, step, edit, label, image = None, probabilities = None):
+        """
+        Args:
+            step (int): Index of the step, the image is saved as step_{step}.jpg.
+            edit (list): The edit, e.g. ["remove", "car", "road"].
+            label: Classification of the edited image.
+        """
+        self.write({"type": "step", "step": step, "action": edit[0], "object": edit[1], "target": edit[2],
+                    "lvlm": self.lvlm_calls, "label": label, "probabilities": probabilities,
+                    "image": image, "timings": self.timings})
+        self.timings = {}
+        self.lvlm_calls = []
+
+    def exception(self, e):
+        # the LVLM calls and timings of the failed step are kept with the exception
+        self.write({"type": "exception", "error": str(e), "lvlm": self.lvlm_calls, "timings": self.timings})
+        self.timings = {}
+        self.lvlm_calls = []
+
+    def end(self, steps):
+        self.write({"type": "end", "steps": steps})
+        self.close()
+
+    def close(self):
+        if not self.handle.closed:
+            self.handle.close()
+
+
+def read_run_log(path):
+    """
+    Streams the records of a run log, a line cut short by an interrupted run is skipped.
+
+    Args:
+        path (str): run_log.jsonl file or the folder of the run.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, RUN_LOG_NAME)
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def summarize_run_log(path):
+    """
+    Returns:
+        dict: number_of_steps, original_classification, final_classification, edits (the steps
+            recorded at the end, None if the run did not finish), exceptions and the total time
+            per stage; the keys returned by the parsers of editor_metric_code.
+    """
+    original, final, num_steps, edits = None, None, 0, None
+    exceptions = 0
+    timings = {}
+    for record in read_run_log(path):
+        for stage, seconds in record.get("timings", {}).items():
+            timings[stage] = timings.get(stage, 0.0) + seconds
+        if record["type"] == "start":
+            original = final = record["label"]
+        elif record["type"] == "step":
+            final = record["label"]
+            num_steps = record["step"]
+        elif record["type"] == "exception":
+            exceptions += 1
+        elif record["type"] == "end":
+            edits = record["steps"]
+
+    return {
+        'number_of_steps': num_steps,
+        'original_classification': original,
+        'final_classification': final,
+        'edits': edits,
+        'exceptions': exceptions,
+        'timings': timings,
+    }
+
+
+def write_logs_txt(run_dir, numbered_steps = False, footer = ""):
+    """
+    Writes run_dir/logs.txt from the run log, in the format the edit loops always wrote by hand
+    (and parse_logs_txt reads), so a run resumed after a crash still gets its whole logs.txt.
+
+    Args:
+        run_dir (str): Folder of the run.
+        numbered_steps (bool): Precede every edit by "Step: i" like the single-step loops.
+        footer (str): Appended after the final steps, e.g. the beam search stats.
+    """
+    text, step = "", 0
+    for record in read_run_log(run_dir):
+        if record["type"] == "start":
+            text += f"Classification: {record['label']}\n"
+        elif record["type"] in ("step", "exception"):
+            i = record["step"] if record["type"] == "step" else step + 1
+            for call in record["lvlm"]:
+                text += f"\n----\nOutput LVLM: {i}\n{call['output']}\n"
+            if record["type"] == "step":
+                edit = [record["action"], record["object"], record["target"]]
+                text += f"Step: {i}\n{edit}\n" if numbered_steps else f"\n{edit}\n"
+                text += f"Classification: {record['label']}\n"
+                step = i
+            else:
+                text += f"Exception: {record['error']}\n"
+        elif record["type"] == "end":
+            text += f"\n\n----\n\n{record['steps']}\n\n----\n\n"
+    with open(os.path.join(run_dir, "logs.txt"), "w") as handle:
+        handle.write(text + footer)
+
+
+def parse_label(text):
+    # "1" -> 1 (BDD100k), "[['office', 0.59], ...]" -> list (places365), "computer_room" -> str (LVLM)
+    text = text.strip()
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_logs_txt(filepath):
+    """
+    Regex parsing of the logs.txt of the runs that predate run_log.jsonl.
+
+    Returns:
+        dict: The keys of summarize_run_log, without the timings.
+    """
+    with open(filepath, 'r') as file:
+        text = file.read()
+
+    classifications = [parse_label(c) for c in re.findall(r"Classification:\s*([^\r\n]+)", text)]
+    steps = re.findall(r'Output LVLM:\s*(\d+)', text)
+
+    # the final edits list, parsed as a Python literal, never executed
+    edits = None
+    edits_matches = re.findall(r'\[\[.*\]\]', text, re.DOTALL)
+    if edits_matches:
+        try:
+            edits = ast.literal_eval(edits_matches[-1])
+        except (ValueError, SyntaxError):
+            pass
+
+    return {
+        'number_of_steps': max(map(int, steps)) if steps else 0,
+        'original_classification': classifications[0] if classifications else None,
+        'final_classification': classifications[-1] if classifications else None,
+        'edits': edits,
+        'exceptions': text.count("Exception:"),
+    }
+
+
+def parse_run_dir(run_dir):
+    """
+    Parses a run folder, preferring the run_log.jsonl written by the edit loops and falling back
+    to logs.txt for the runs that predate it.
+
+    Returns:
+        dict: See summarize_run_log, None if the folder has neither log.
+    """
+    run_log_path = os.path.join(run_dir, RUN_LOG_NAME)
+    if os.path.isfile(run_log_path):
+        return summarize_run_log(run_log_path)
+    logs_path = os.path.join(run_dir, "logs.txt")
+    if os.path.isfile(logs_path):
+        return parse_logs_txt(logs_path)
+    return None
+
+
+def scan_run_dirs(base_directory):
+    """
+    Yields the os.DirEntry of every run folder of base_directory. os.scandir gets the entry type
+    from the directory listing, so no extra stat call per entry is needed.
+    """
+    with os.scandir(base_directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield entry
+
+
+def _call(args):
+    fn, run_dir = args
+    try:
+        return fn(run_dir), None
+    except Exception as e:
+        return None, e
+
+
+def map_runs(fn, run_dirs, max_workers = None, chunksize = 64):
+    """
+    Applies fn to every run folder, in a process pool.
+
+    Args:
+        fn (callable): Module-level (picklable) function of a run folder, e.g. parse_run_dir.
+        run_dirs (list): The run folders.
+        max_workers (int, optional): Processes, 1 runs in this process.
+
+    Returns:
+        list: (result, exception) per run folder, in order; exception is None if fn succeeded.
+    """
+    jobs = [(fn, run_dir) for run_dir in run_dirs]
+    if max_workers == 1 or len(jobs) < 2:
+        return [_call(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_call, jobs, chunksize=chunksize))
+
+
+def top_label(classification):
+    # "computer_room" (LVLM), 1 (BDD100k) or [['office', 0.59], ...] (places365 top-k) -> the top label
+    if isinstance(classification, list) and classification and isinstance(classification[0], (list, tuple)):
+        return classification[0][0]
+    return classification
+
+
+def label_changed(original_class, final_class):
+    return top_label(original_class) != top_label(final_class)
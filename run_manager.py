@@ -0,0 +1,199 @@
+import glob
+import json
+import os
+import shutil
+import time
+import zlib
+
+
+PENDING = "pending"
+IN_PROGRESS = "in_progress"
+DONE = "done"
+FAILED = "failed"
+
+
+# Resumable runs for the edit loops. Instead of create_or_replace_dir + a fresh loop, an edit
+# function asks the manager where the image stands and continues from there, e.g.
+#
+#   state = runs.start(image_id)                  # keeps the folder if steps were already saved
+#   source_image_path = state["last_image"]       # source.jpg or the last saved step_i.jpg
+#   i = state["steps_completed"] + 1
+#   steps = state["steps"]
+#   if state["orig_label"] is None:
+#       ...                                       # fresh run: fetch and classify the source
+#       runs.record_label(image_id, orig_label)
+#   runs.load_chat(image_id, chat)
+#   ...
+#   new_image.save(step_path)
+#   runs.record_step(image_id, i, step_path, ["remove", obj, background], chat=chat)
+#   new_label = classify(step_path)
+#   runs.record_label(image_id, new_label, step=i)
+#   ...
+#   runs.done(image_id)                           # or runs.failed(image_id, str(e))
+#
+# A step is journaled as soon as its image has been saved, before it is classified, so completed
+# inpainting calls are never redone; a resumed run whose last step has no label (state["label"] is
+# None with steps_completed > 0) only classifies that step again.
+
+
+def shard_of(key, num_shards):
+    # stable across processes and interpreter runs, unlike hash()
+    return zlib.crc32(str(key).encode("utf-8")) % num_shards
+
+
+class RunManager:
+    """
+    Journal of the per-image state of an edit experiment.
+
+    Every state change is appended to a JSONL journal in run_dir (one file per shard, so that
+    worker processes never write to the same file) and the state is rebuilt from all the journals
+    on start-up.
+
+    Args:
+        run_dir (str): Folder of the experiment, e.g. "imgs/random/claude-3-5-sonnet/global".
+        shard (int): Index of this worker.
+        num_shards (int): Number of workers the image ids are split across.
+    """
+
+    def __init__(self, run_dir, shard = 0, num_shards = 1):
+        self.run_dir = run_dir
+        self.shard = shard
+        self.num_shards = num_shards
+        os.makedirs(run_dir, exist_ok=True)
+        self.journal_path = os.path.join(run_dir, f"journal_{shard}.jsonl")
+        self.states = {}
+        for path in sorted(glob.glob(os.path.join(run_dir, "journal_*.jsonl"))):
+            self._replay(path)
+        self.journal = open(self.journal_path, "a")
+
+    def _replay(self, path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue    # a line cut short by a crash
+                self._apply(record)
+
+    def _apply(self, record):
+        if record.get("reset"):
+            self.states.pop(record["image_id"], None)
+        state = self.states.setdefault(record["image_id"], self._initial_state(record["image_id"]))
+        state["status"] = record["status"]
+        state["updated"] = record["time"]
+        if "orig_label" in record:
+            state["orig_label"] = record["orig_label"]
+        if record.get("label_step") is not None and record["label_step"] == state["steps_completed"]:
+            state["label"] = record["label"]
+        if record["status"] == IN_PROGRESS and "step" in record:
+            state["steps_completed"] = record["step"]
+            state["last_image"] = record["image"]
+            state["steps"].append(record["edit"])
+            state["label"] = record.get("label")
+            state["chat"] = record.get("chat")
+        if "error" in record:
+            state["error"] = record["error"]
+
+    def _initial_state(self, image_id):
+        return {"status": PENDING,
+                "steps_completed": 0,
+                "last_image": os.path.join(self.image_dir(image_id), "source.jpg"),
+                "steps": [],
+                "orig_label": None,
+                "label": None,
+                "chat": None}
+
+    def _write(self, record):
+        record["time"] = time.time()
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self._apply(record)
+
+    def image_dir(self, image_id):
+        return os.path.join(self.run_dir, str(image_id))
+
+    def state(self, image_id):
+        return self.states.get(image_id, self._initial_state(image_id))
+
+    def pending(self, keys, retry_failed = True):
+        # the keys of this shard that still have to be run
+        todo = [FAILED, PENDING, IN_PROGRESS] if retry_failed else [PENDING, IN_PROGRESS]
+        return [k for k in keys if shard_of(k, self.num_shards) == self.shard and self.state(k)["status"] in todo]
+
+    def start(self, image_id):
+        """
+        Marks the image as in progress and prepares its folder: a run without saved steps starts
+        from an empty folder (and forgets its original label), otherwise the folder is kept and the
+        state tells where to resume.
+
+        Returns:
+            dict: status, steps_completed, last_image, the steps done so far, orig_label (None on a
+                fresh run), the label of the last step and its chat file.
+        """
+        state = self.state(image_id)
+        if state["steps_completed"] == 0:
+            if os.path.exists(self.image_dir(image_id)):
+                shutil.rmtree(self.image_dir(image_id))
+            os.makedirs(self.image_dir(image_id))
+            self._write({"image_id": image_id, "status": IN_PROGRESS, "reset": True})
+        else:
+            self._write({"image_id": image_id, "status": IN_PROGRESS})
+        # a copy, the loop appends its new steps to it before they are journaled
+        state = dict(self.state(image_id))
+        state["steps"] = list(state["steps"])
+        return state
+
+    def record_label(self, image_id, label, step = None):
+        # classification of the source (or of the given saved step), a resumed run does not classify it again
+        if step is None:
+            self._write({"image_id": image_id, "status": IN_PROGRESS, "orig_label": label})
+        else:
+            self._write({"image_id": image_id, "status": IN_PROGRESS, "label_step": step, "label": label})
+
+    def record_step(self, image_id, step, image_path, edit, label = None, chat = None):
+        """
+        Journals a step whose image has been saved. The label can be given here or, to journal the
+        step before classifying it, with record_label(image_id, label, step) afterwards.
+
+        The chat is saved to its own chat_step_{step}.json, which only the journal entry of the step
+        points to, so a crash between the two leaves the previous step and its chat in force. The chat
+        of the previous step is deleted once the entry is written.
+        """
+        record = {"image_id": image_id, "status": IN_PROGRESS, "step": step, "image": image_path,
+                  "edit": edit, "label": label}
+        previous = self.state(image_id)["chat"]
+        if chat is not None:
+            record["chat"] = f"chat_step_{step}.json"
+            chat_path = os.path.join(self.image_dir(image_id), record["chat"])
+            with open(chat_path + ".tmp", "w") as f:
+                json.dump(chat.payload, f)
+            os.replace(chat_path + ".tmp", chat_path)
+        self._write(record)
+        if previous is not None and previous != record.get("chat"):
+            try:
+                os.remove(os.path.join(self.image_dir(image_id), previous))
+            except FileNotFoundError:
+                pass
+
+    def load_chat(self, image_id, chat):
+        state = self.state(image_id)
+        if state["chat"] is not None:
+            with open(os.path.join(self.image_dir(image_id), state["chat"])) as f:
+                chat.payload = json.load(f)
+        return chat
+
+    def done(self, image_id):
+        self._write({"image_id": image_id, "status": DONE})
+
+    def failed(self, image_id, error):
+        self._write({"image_id": image_id, "status": FAILED, "error": str(error)})
+
+    def summary(self):
+        counts = {PENDING: 0, IN_PROGRESS: 0, DONE: 0, FAILED: 0}
+        for state in self.states.values():
+            counts[state["status"]] += 1
+        return counts
+
+    def close(self):
+        self.journal.close()
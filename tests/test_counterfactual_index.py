@@ -0,0 +1,87 @@
+import itertools
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from counterfactual_index import CounterfactualIndex, concept_count_bound, concept_counts
+
+
+# objects as cece builds them: the surface word and its WordNet hypernym chain
+CHAINS = {
+    "car": ["car", "car.n.01", "motor_vehicle.n.01", "vehicle.n.01", "entity.n.01"],
+    "truck": ["truck", "truck.n.01", "motor_vehicle.n.01", "vehicle.n.01", "entity.n.01"],
+    "bicycle": ["bicycle", "bicycle.n.01", "vehicle.n.01", "entity.n.01"],
+    "person": ["person", "person.n.01", "organism.n.01", "entity.n.01"],
+    "rider": ["rider", "rider.n.01", "person.n.01", "organism.n.01", "entity.n.01"],
+    "dog": ["dog", "dog.n.01", "animal.n.01", "organism.n.01", "entity.n.01"],
+    "traffic light": ["traffic light", "traffic_light.n.01", "light.n.02", "entity.n.01"],
+    "sign": ["sign", "sign.n.02", "signal.n.01", "entity.n.01"],
+}
+
+
+class Row:
+
+    def __init__(self, objects):
+        self.concepts = [set(CHAINS[o]) for o in objects]
+
+
+class FakeDataset:
+    # cece's cost model: the shorter row is padded with empty objects and the objects are matched
+    # to minimise the sum of the symmetric differences (brute force, the rows are small)
+
+    def __init__(self, rows):
+        self.dataset = [Row(r) for r in rows]
+
+    def find_edits(self, source, target):
+        a, b = list(source.concepts), list(target.concepts)
+        n = max(len(a), len(b))
+        a += [set()] * (n - len(a))
+        b += [set()] * (n - len(b))
+        best = None
+        for perm in itertools.permutations(range(n)):
+            cost = sum(len(a[i] ^ b[j]) for i, j in enumerate(perm))
+            if best is None or cost < best[0]:
+                best = (cost, perm)
+        return best[0], {"matching": best[1]}
+
+
+def make_dataset(n_rows = 120, seed = 0):
+    rng = random.Random(seed)
+    names = sorted(CHAINS)
+    rows = [[rng.choice(names) for _ in range(rng.randint(1, 5))] for _ in range(n_rows)]
+    labels = [rng.randint(0, 2) for _ in range(n_rows)]
+    return FakeDataset(rows), labels
+
+
+def brute_force(ds, labels, i):
+    # ds.explain: minimum cost over the rows of another label, lowest row index among ties
+    costs = [(ds.find_edits(ds.dataset[i], row)[0], j) for j, row in enumerate(ds.dataset) if labels[j] != labels[i]]
+    cost, j = min(costs)
+    return j, cost
+
+
+def test_bound_is_below_the_cost():
+    ds, _ = make_dataset(40)
+    for source in ds.dataset:
+        for target in ds.dataset:
+            assert concept_count_bound(concept_counts(source.concepts), concept_counts(target.concepts)) <= ds.find_edits(source, target)[0]
+
+
+def test_same_result_as_exhaustive_search():
+    ds, labels = make_dataset()
+    index = CounterfactualIndex(ds, labels)
+    for i in range(len(labels)):
+        target_index, cost, _ = index.explain(i, labels[i])
+        assert (target_index, cost) == brute_force(ds, labels, i)
+
+
+def test_lower_bound_reduces_exact_evaluations():
+    ds, labels = make_dataset()
+    pruned = CounterfactualIndex(ds, labels)
+    exhaustive = CounterfactualIndex(ds, labels, lower_bound=False)
+    assert pruned.explain_all() == exhaustive.explain_all()
+    queries = len(pruned.cache)
+    # a handful of find_edits per distinct source instead of one per group of another label
+    assert pruned.exact_calls * 10 < exhaustive.exact_calls
+    assert pruned.exact_calls / queries < 10
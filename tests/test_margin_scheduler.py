@@ -0,0 +1,90 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from margin_scheduler import MarginScheduler
+
+
+CLASSES = ("beach", "forest", "street")
+
+
+class StubPlaces365:
+    # places365 Classifier contract: margin returns (top class name, margin) and the margin is
+    # measured for a class name given as reference
+
+    def __init__(self, probs):
+        # image path -> probability of each of CLASSES
+        self.probs = probs
+        self.classify_calls = 0
+
+    def classify(self, image_path):
+        self.classify_calls += 1
+        probs = self.probs[image_path]
+        return CLASSES[max(range(len(CLASSES)), key=lambda i: probs[i])]
+
+    def margin(self, image_path, reference = None):
+        probs = self.probs[image_path]
+        top = max(range(len(CLASSES)), key=lambda i: probs[i])
+        ref = top if reference is None else CLASSES.index(reference)
+        others = max(p for i, p in enumerate(probs) if i != ref)
+        return CLASSES[top], probs[ref] - others
+
+
+PROBS = {"source.jpg": (0.8, 0.1, 0.1),
+         "step_1.jpg": (0.6, 0.3, 0.1),
+         "step_2.jpg": (0.3, 0.6, 0.1)}
+
+
+def test_start_keeps_a_class_name_as_reference():
+    cnn = StubPlaces365(PROBS)
+    scheduler = MarginScheduler(cnn.classify, cnn.margin, threshold=0.2)
+    margin = scheduler.start("source.jpg", "beach")
+    assert scheduler.cheap_label == "beach"
+    assert abs(margin - 0.7) < 1e-9
+
+
+def test_classify_skips_above_threshold_and_classifies_near_the_boundary():
+    cnn = StubPlaces365(PROBS)
+    scheduler = MarginScheduler(cnn.classify, cnn.margin, threshold=0.2)
+    scheduler.start("source.jpg", "beach")
+
+    assert scheduler.classify("step_1.jpg", edit="umbrella") == "beach"
+    assert scheduler.stats["skipped"] == 1 and cnn.classify_calls == 0
+
+    assert scheduler.classify("step_2.jpg", edit="tree") == "forest"
+    assert scheduler.stats["expensive"] == 1 and cnn.classify_calls == 1
+
+    # margin of beach: 0.7 -> 0.3 -> -0.3
+    assert abs(scheduler.score("umbrella") - 0.4) < 1e-9
+    assert abs(scheduler.score("tree") - 0.6) < 1e-9
+    assert [e for e, _ in scheduler.rerank([("umbrella", 1), ("tree", 2), ("car", 3)])] == ["tree", "umbrella", "car"]
+
+
+def test_audit_raises_the_threshold_on_a_missed_flip():
+    # the cheap classifier is still confident while the expensive one already flipped
+    probs = dict(PROBS, **{"step_1.jpg": (0.7, 0.2, 0.1)})
+    expensive = {"step_1.jpg": "street"}
+    cnn = StubPlaces365(probs)
+    scheduler = MarginScheduler(expensive.get, cnn.margin, threshold=0.2, audit_every=1, growth=1.5)
+    scheduler.start("source.jpg", "beach")
+
+    assert scheduler.classify("step_1.jpg") == "street"
+    assert scheduler.stats["audited"] == 1 and scheduler.stats["missed_flips"] == 1
+    assert abs(scheduler.threshold - 0.75) < 1e-9
+
+
+def test_mask_and_resume_go_to_the_cheap_margin():
+    cnn = StubPlaces365(PROBS)
+    calls = []
+
+    def margin(image_path, reference = None, mask = None):
+        calls.append((image_path, reference, mask))
+        return cnn.margin(image_path, reference)
+
+    scheduler = MarginScheduler(cnn.classify, margin, threshold=0.2)
+    scheduler.start("source.jpg", "beach", last_image="step_1.jpg")
+    # the drop of the next edit is measured from the last saved step
+    assert abs(scheduler.last_margin - 0.3) < 1e-9
+    scheduler.classify("step_2.jpg", edit="tree", mask="mask_2")
+    assert calls == [("source.jpg", None, None), ("step_1.jpg", "beach", None), ("step_2.jpg", "beach", "mask_2")]
+    assert abs(scheduler.score("tree") - 0.6) < 1e-9
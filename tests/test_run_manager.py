@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from run_manager import RunManager
+
+
+class Chat:
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+def test_step_saved_before_its_classification_is_not_redone(tmp_path):
+    runs = RunManager(str(tmp_path))
+    runs.start("a")
+    runs.record_label("a", "beach")
+    runs.record_step("a", 1, "a/step_1.jpg", ["add", "tree", "grass"], chat=Chat({"turn": 1}))
+    runs.record_label("a", "beach", step=1)
+    runs.record_step("a", 2, "a/step_2.jpg", ["remove", "sand", "grass"], chat=Chat({"turn": 2}))
+    runs.close()
+
+    # interrupted while classifying step 2: the resumed run starts after it, with no label for it
+    runs = RunManager(str(tmp_path))
+    state = runs.start("a")
+    assert state["steps_completed"] == 2
+    assert state["last_image"] == "a/step_2.jpg"
+    assert state["label"] is None and state["orig_label"] == "beach"
+    assert runs.load_chat("a", Chat(None)).payload == {"turn": 2}
+
+    runs.record_label("a", "forest", step=2)
+    runs.close()
+    assert RunManager(str(tmp_path)).state("a")["label"] == "forest"
+
+
+def test_fresh_start_forgets_the_label(tmp_path):
+    runs = RunManager(str(tmp_path))
+    runs.start("a")
+    runs.record_label("a", "beach")
+    state = runs.start("a")
+    assert state["orig_label"] is None and state["steps_completed"] == 0
+    assert os.path.isdir(runs.image_dir("a"))
@@ -0,0 +1,125 @@
+import os
+import pickle
+
+
+# bump when the stored format changes
+VOCAB_VERSION = 1
+
+
+class ConceptVocabulary:
+    """
+    Vocabulary-level cache of the WordNet expansion of object names.
+
+    BDD100k and VG only have a small vocabulary of categories, so each name is expanded with
+    connect_term_to_wordnet once and the cache can be persisted between sessions. Every row gets
+    its own set of concepts, as when the notebooks called connect_term_to_wordnet per object.
+
+    Args:
+        expand_fn (callable, optional): Term expansion, defaults to cece.wordnet.connect_term_to_wordnet.
+        path (str, optional): Pickle file the cache is loaded from (if it exists) and saved to.
+        drop_unknown (bool): Retry a term that fails to expand without its spaces and drop it if that
+            fails too (the BDD100k notebooks did so), the dropped terms are printed and counted in
+            dropped. False lets the error of expand_fn propagate.
+    """
+
+    def __init__(self, expand_fn = None, path = None, drop_unknown = False):
+        if expand_fn is None:
+            from cece.wordnet import connect_term_to_wordnet
+            expand_fn = connect_term_to_wordnet
+        self.expand_fn = expand_fn
+        self.path = path
+        self.drop_unknown = drop_unknown
+        self.expansions = {}
+        # term -> number of objects dropped because the term could not be connected to WordNet
+        self.dropped = {}
+        self.concept_ids = {}
+        self.concepts = []
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def _expand(self, term, surface):
+        if not self.drop_unknown:
+            return frozenset(self.expand_fn(term).union([surface]))
+        try:
+            return frozenset(self.expand_fn(term).union([surface]))
+        except Exception:
+            try:
+                return frozenset(self.expand_fn(term.replace(" ", "")).union([surface.replace(" ", "")]))
+            except Exception as e:
+                print(f"Could not connect {term!r} to WordNet, its objects are dropped: {e}")
+                return None
+
+    def expand(self, term, surface = None):
+        """
+        Expands a term to its WordNet concepts plus its surface name.
+
+        Args:
+            term (str): Name to connect to WordNet.
+            surface (str, optional): Name added to the concepts, defaults to the term itself.
+
+        Returns:
+            set: A new set of the concepts, or None if drop_unknown and the term cannot be connected
+                to WordNet.
+        """
+        key = (term, surface)
+        if key not in self.expansions or (self.expansions[key] is None and not self.drop_unknown):
+            self.expansions[key] = self._expand(term, term if surface is None else surface)
+        concepts = self.expansions[key]
+        return set(concepts) if concepts is not None else None
+
+    def build_rows(self, rows, surface_fn = None):
+        """
+        Maps rows of object names to rows of concept sets.
+
+        Args:
+            rows (list): List of lists of object names.
+            surface_fn (callable, optional): Maps an object name to the surface name kept in its
+                concepts, e.g. lambda o: o.split(".")[0] for the VG synset names.
+        """
+        msq_dataset = []
+        for row in rows:
+            msq = []
+            for obj in row:
+                concepts = self.expand(obj, surface_fn(obj) if surface_fn is not None else None)
+                if concepts is None:
+                    self.dropped[obj] = self.dropped.get(obj, 0) + 1
+                else:
+                    msq.append(concepts)
+            msq_dataset.append(msq)
+        return msq_dataset
+
+    def concept_id(self, concept):
+        if concept not in self.concept_ids:
+            self.concept_ids[concept] = len(self.concepts)
+            self.concepts.append(concept)
+        return self.concept_ids[concept]
+
+    def encode_rows(self, msq_dataset):
+        # each object becomes a sorted tuple of integer concept ids, identical objects share the tuple
+        encoded_objects = {}
+        encoded = []
+        for row in msq_dataset:
+            encoded_row = []
+            for concepts in row:
+                concepts = frozenset(concepts)
+                if concepts not in encoded_objects:
+                    encoded_objects[concepts] = tuple(sorted(self.concept_id(c) for c in concepts))
+                encoded_row.append(encoded_objects[concepts])
+            encoded.append(encoded_row)
+        return encoded
+
+    def save(self, path = None):
+        with open(path or self.path, "wb") as handle:
+            pickle.dump({"version": VOCAB_VERSION,
+                         "expansions": self.expansions,
+                         "concepts": self.concepts}, handle)
+
+    def load(self, path):
+        with open(path, "rb") as handle:
+            stored = pickle.load(handle)
+        if stored.get("version") != VOCAB_VERSION:
+            return False
+        self.expansions = stored["expansions"]
+        self.concepts = list(stored["concepts"])
+        self.concept_ids = {c: i for i, c in enumerate(self.concepts)}
+        return True